@@ -0,0 +1,111 @@
+# mongo_concurrency_benchmark.py
+# 1つのgunicornワーカー（イベントループ1つ）で処理できる同時リクエスト数について、
+# 同期ドライバ（移行前: async関数内でpymongoを直接呼ぶ）と非同期ドライバ（移行後: AsyncMongoClient）を比較する。
+#
+# 使用法（リポジトリのルートで実行。MongoDBが必要）:
+#   MONGO_URL=mongodb://localhost:27017 python benchmarks/mongo_concurrency_benchmark.py
+#
+# 各リクエストは、get_current_userのユーザー検索と、temp_list相当のfs.files検索を1回ずつ行う。
+# 計測用のデータは benchmark_db データベースに作成し、終了時に削除する。
+# 結果はMarkdownの表で出力する（documents/readme.md の「計測結果」にそのまま貼り付けられる）。
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from pymongo import AsyncMongoClient, MongoClient
+from pymongo.errors import ServerSelectionTimeoutError
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+BENCHMARK_DB = "benchmark_db"
+CONCURRENCY = [1, 10, 50]
+REQUESTS_PER_CLIENT = 50
+
+
+def setup():
+    client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=5000)
+    db = client[BENCHMARK_DB]
+    db.users.insert_one({"email": "bench@example.com", "role": "photographer"})
+    db.fs.files.insert_many([
+        {"filename": f"G_P_{i}_full.jpeg", "group_id": "G", "photographer_id": "P", "temporary": True}
+        for i in range(10)
+    ])
+    client.close()
+
+
+def teardown():
+    client = MongoClient(MONGO_URL)
+    client.drop_database(BENCHMARK_DB)
+    client.close()
+
+
+async def run_sync_driver(concurrency: int) -> list[float]:
+    """移行前: async関数の中で同期ドライバを呼ぶ（待ち時間の間イベントループが止まる）"""
+    db = MongoClient(MONGO_URL)[BENCHMARK_DB]
+
+    async def handle_request():
+        db.users.find_one({"email": "bench@example.com"})
+        list(db.fs.files.find({"group_id": "G", "photographer_id": "P", "temporary": True}))
+
+    try:
+        return await run_clients(handle_request, concurrency)
+    finally:
+        db.client.close()
+
+
+async def run_async_driver(concurrency: int) -> list[float]:
+    """移行後: 非同期ドライバを await する（待ち時間の間に他のリクエストを処理できる）"""
+    client = AsyncMongoClient(MONGO_URL, maxPoolSize=max(concurrency, 10))
+    db = client[BENCHMARK_DB]
+
+    async def handle_request():
+        await db.users.find_one({"email": "bench@example.com"})
+        await db.fs.files.find({"group_id": "G", "photographer_id": "P", "temporary": True}).to_list()
+
+    try:
+        return await run_clients(handle_request, concurrency)
+    finally:
+        await client.close()
+
+
+async def run_clients(handle_request, concurrency: int) -> list[float]:
+    latencies = []
+
+    async def client_loop():
+        for _ in range(REQUESTS_PER_CLIENT):
+            start = time.perf_counter()
+            await handle_request()
+            latencies.append(time.perf_counter() - start)
+
+    await handle_request() # 接続の確立を計測から除く
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    return latencies
+
+
+async def main():
+    try:
+        setup()
+    except ServerSelectionTimeoutError as e:
+        print(f"MongoDBに接続できません（{MONGO_URL}）: {e}", file=sys.stderr)
+        return 1
+    try:
+        print("| driver | clients | req/s | p50 (ms) | p95 (ms) |")
+        print("| --- | ---: | ---: | ---: | ---: |")
+        for concurrency in CONCURRENCY:
+            for label, runner in (("sync", run_sync_driver), ("async", run_async_driver)):
+                start = time.perf_counter()
+                latencies = await runner(concurrency)
+                elapsed = time.perf_counter() - start
+                latencies.sort()
+                p95 = latencies[int(len(latencies) * 0.95) - 1]
+                print(f"| {label} | {concurrency} | {len(latencies) / elapsed:.1f} | "
+                      f"{statistics.median(latencies) * 1000:.2f} | {p95 * 1000:.2f} |")
+    finally:
+        teardown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,125 @@
+# qr_decode_benchmark.py
+# process_imageのQRコード検出・トリミングについて、
+# フル解像度でデコードする方式と、縮小デコード（粗密2段階）方式の処理時間とピークメモリを比較する。
+#
+# 使用法（リポジトリのルートで実行）:
+#   python benchmarks/qr_decode_benchmark.py
+#
+# 12MP（4000x3000）と48MP（8000x6000）のスマートフォン写真を想定した、QRコード3つを含むJPEGを生成して計測する。
+# ピークメモリは計測ごとに新しいプロセスを起動し、ru_maxrss（プロセスの最大RSS）で比較する。
+
+import io
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REPEAT = 3
+SIZES = {
+    "12MP": (4000, 3000, 400),
+    "48MP": (8000, 6000, 800),
+}
+
+
+def make_test_image(width: int, height: int, qr_size: int) -> bytes:
+    """
+    撮影用治具を想定して、画像の右半分にQRコードを3つ配置したJPEGを生成する。
+    """
+    import qrcode
+    from PIL import Image
+
+    img = Image.new("RGB", (width, height), (180, 170, 160))
+    positions = [
+        (width // 2 + qr_size // 2, qr_size),
+        (width // 2 + qr_size // 2, height - qr_size * 2),
+        (width - qr_size * 2, qr_size),
+    ]
+    for i, (x, y) in enumerate(positions):
+        qr = qrcode.make(f"F{i + 1}").convert("RGB").resize((qr_size, qr_size))
+        img.paste(qr, (x, y))
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=92)
+    return buffer.getvalue()
+
+
+def decode_full(image_data: bytes):
+    """従来方式のデコード: フル解像度でデコードしてEXIF回転を適用する"""
+    from services.image_processing import load_and_orient_image_pil
+
+    return load_and_orient_image_pil(image_data)
+
+
+def decode_coarse(image_data: bytes):
+    """縮小デコード: QRコード検出に必要な1800pxを下回らない範囲で縮小デコードする"""
+    from services.image_processing import load_reduced_image_pil, oriented_size, choose_draft_scale
+
+    return load_reduced_image_pil(image_data, choose_draft_scale(max(oriented_size(image_data)), 1800))
+
+
+def run_full(image_data: bytes):
+    """従来方式: フル解像度でデコードしてからQRコードを検出し、トリミングする"""
+    from services.image_processing import ImagePipeline, find_crop_box, max_dim
+
+    pipeline = ImagePipeline.from_bytes(image_data)
+    box, _ = find_crop_box(pipeline.image, 1.0, 0, 0, "benchmark")
+    if box is not None:
+        pipeline.crop_square(box)
+    pipeline.fit(max_dim)
+    return pipeline.render()
+
+
+def run_coarse(image_data: bytes):
+    """粗密2段階方式: 縮小デコードした画像でQRコードを検出し、必要な解像度でトリミングする"""
+    from services.image_processing import crop_by_qr
+
+    pipeline, _ = crop_by_qr(image_data, 0, 0, "auto", "benchmark")
+    return pipeline.render()
+
+
+METHODS = {
+    "full": (decode_full, run_full),
+    "coarse": (decode_coarse, run_coarse),
+}
+
+
+def best_time(func, image_data: bytes) -> float:
+    elapsed = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(image_data)
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+def measure(method: str, image_data: bytes, queue):
+    logging.disable(logging.INFO)
+    import services.image_processing # import分のメモリを計測から除く
+    decode, run = METHODS[method]
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    decode_time = best_time(decode, image_data)
+    total_time = best_time(run, image_data)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((decode_time, total_time, baseline_rss / 1024, peak_rss / 1024))
+
+
+def main():
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'image':<6} {'method':<8} {'decode (ms)':>12} {'total (ms)':>11} {'baseline RSS (MB)':>18} {'peak RSS (MB)':>14}")
+    for label, (width, height, qr_size) in SIZES.items():
+        image_data = make_test_image(width, height, qr_size)
+        for method in METHODS:
+            queue = ctx.Queue()
+            process = ctx.Process(target=measure, args=(method, image_data, queue))
+            process.start()
+            decode_time, total_time, baseline_mb, peak_mb = queue.get()
+            process.join()
+            print(f"{label:<6} {method:<8} {decode_time * 1000:>12.1f} {total_time * 1000:>11.1f} {baseline_mb:>18.1f} {peak_mb:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from pymongo.database import Database
+from pymongo.asynchronous.database import AsyncDatabase
 from typing import Optional, List
 from bson import ObjectId
 from datetime import datetime
@@ -6,12 +6,12 @@ from datetime import datetime
 from schemas import UserCreate, UserInDB
 from auth import get_password_hash
 
-def get_user(db: Database, user_id: str) -> Optional[UserInDB]:
+async def get_user(db: AsyncDatabase, user_id: str) -> Optional[UserInDB]:
     """
     IDを使用して、データベースからユーザーを検索する。
     """
     try:
-        user_data = db.users.find_one({"_id": ObjectId(user_id)})
+        user_data = await db.users.find_one({"_id": ObjectId(user_id)})
         if user_data:
             user_data["_id"] = str(user_data["_id"])
             return UserInDB(**user_data)
@@ -19,27 +19,27 @@ def get_user(db: Database, user_id: str) -> Optional[UserInDB]:
     except Exception:
         return None
 
-def get_user_by_email(db: Database, email: str) -> Optional[UserInDB]:
+async def get_user_by_email(db: AsyncDatabase, email: str) -> Optional[UserInDB]:
     """
     メールアドレスを使用して、データベースからユーザーを検索する。
     """
-    user_data = db.users.find_one({"email": email})
+    user_data = await db.users.find_one({"email": email})
     if user_data:
         user_data["_id"] = str(user_data["_id"])
         return UserInDB(**user_data)
     return None
 
-def get_photographers(db: Database) -> List[UserInDB]:
+async def get_photographers(db: AsyncDatabase) -> List[UserInDB]:
     """
     役割が'photographer'のすべてのユーザーを取得する。
     """
     users = []
-    for user_data in db.users.find({"role": "photographer"}):
+    async for user_data in db.users.find({"role": "photographer"}):
         user_data["_id"] = str(user_data["_id"])
         users.append(UserInDB(**user_data))
     return users
 
-def create_user(db: Database, user: UserCreate) -> UserInDB:
+async def create_user(db: AsyncDatabase, user: UserCreate) -> UserInDB:
     """
     新しいユーザーを作成し、データベースに保存する。
     """
@@ -50,17 +50,17 @@ def create_user(db: Database, user: UserCreate) -> UserInDB:
     user_dict["is_active"] = True
     user_dict["created_at"] = datetime.utcnow()
 
-    result = db.users.insert_one(user_dict)
-    created_user = get_user(db, user_id=str(result.inserted_id))
+    result = await db.users.insert_one(user_dict)
+    created_user = await get_user(db, user_id=str(result.inserted_id))
     return created_user
 
 
-def delete_user_by_id(db: Database, user_id: str) -> bool:
+async def delete_user_by_id(db: AsyncDatabase, user_id: str) -> bool:
     """
     指定されたIDのユーザーを削除する。
     """
     try:
-        result = db.users.delete_one({"_id": ObjectId(user_id)})
+        result = await db.users.delete_one({"_id": ObjectId(user_id)})
         return result.deleted_count > 0
     except Exception:
         return False
@@ -1,15 +1,159 @@
 # admin.py, photograper.py, external.pyから、参照するための設定
-# 
-from pymongo import MongoClient
+#
+# MongoDBへのアクセスは非同期ドライバ（PyMongoのAsyncMongoClient）を使用する。
+# ハンドラー内では必ず await すること（イベントループをブロックしないため）。
+#
+# MongoClientはimport時ではなく、アプリのlifespan（main.py）で connect() を呼んでワーカーごとに生成する。
+# gunicornがワーカーをforkした後に接続を作るため、接続プールが複数のプロセスで共有されることはない。
+# 各モジュールからは `from db import mongo` として、mongo.db / mongo.collection / mongo.fs を参照する。
+#
+# 環境変数で設定できる項目:
+#   MONGO_URL                   : MongoDBの接続URL（Fly.ioのSecretに設定）
+#   MONGO_MAX_POOL_SIZE         : ワーカーごとの最大接続数（既定: 50）
+#   MONGO_MIN_POOL_SIZE         : ワーカーごとに維持する最小接続数（既定: 0）
+#   MONGO_WAIT_QUEUE_TIMEOUT_MS : 接続プールが空くのを待つ最大時間（既定: 5000）
+#   MONGO_COMPRESSORS           : 通信の圧縮方式（例: "zstd,snappy"。zstandard / python-snappy が必要）
+#   MONGO_READ_PREFERENCE       : 読み込み設定（例: "primary", "secondaryPreferred"）
+#   MONGO_SERVER_SELECTION_TIMEOUT_MS : サーバー選択のタイムアウト（既定: 10000）
+#   MONGO_USE_TRANSACTIONS      : "true" の場合、複数の書き込みをトランザクションで行う（レプリカセット構成が必要。既定: false）
+from pymongo import AsyncMongoClient, monitoring
 import gridfs
 import os
+import threading
+import time
 
 # MongoDBの接続情報
 # Fly.ioのSecretに設定した環境変数 MONGO_URL を読み込む
 MONGO_URL = os.environ.get("MONGO_URL")
+DATABASE_NAME = "image_db"
+MONGO_USE_TRANSACTIONS = os.environ.get("MONGO_USE_TRANSACTIONS", "false").lower() == "true"
 
-# 以下のコードは変更しなくても大丈夫です。
-client = MongoClient(MONGO_URL)
-db = client["image_db"]
-collection = db["images"]
-fs = gridfs.GridFS(db)
\ No newline at end of file
+
+def mongo_client_options() -> dict:
+    """
+    環境変数からMongoClientの接続プール設定を組み立てる。
+    """
+    options = {
+        "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", "50")),
+        "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", "0")),
+        "waitQueueTimeoutMS": int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+        "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000")),
+    }
+    if compressors := os.environ.get("MONGO_COMPRESSORS"):
+        options["compressors"] = compressors
+    if read_preference := os.environ.get("MONGO_READ_PREFERENCE"):
+        options["readPreference"] = read_preference
+    return options
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    接続プールのイベントを集計し、使用状況（貸し出し中の接続数、待ち時間など）を記録するリスナー。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.open_connections = 0
+            self.checked_out = 0
+            self.max_checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.total_wait_ms = 0.0
+            self.max_wait_ms = 0.0
+            self.started_at = time.time()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "open_connections": self.open_connections,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "avg_wait_ms": round(self.total_wait_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 3),
+                "since": self.started_at,
+            }
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    def connection_checked_out(self, event):
+        wait_ms = event.duration * 1000
+        with self._lock:
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.checkouts += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
+
+
+class Mongo:
+    """
+    ワーカーごとのMongoClientと、よく使うデータベース・コレクションへの参照を保持する。
+    connect() を呼ぶまでは各属性はNone。
+    """
+
+    def __init__(self):
+        self.client: AsyncMongoClient | None = None
+        self.db = None
+        self.collection = None
+        self.fs = None
+        self.resumable_uploads = None # 再開可能アップロードのセッション情報
+        self.upload_states = None # 撮影中（本登録前）の一時画像の一覧。group_idとphotographer_idごとに1件
+        self.pool_stats = PoolStatsListener()
+
+    async def connect(self):
+        if self.client is not None:
+            return
+        self.pool_stats.reset()
+        self.client = AsyncMongoClient(MONGO_URL, event_listeners=[self.pool_stats], **mongo_client_options())
+        self.db = self.client[DATABASE_NAME]
+        self.collection = self.db["images"]
+        self.fs = gridfs.AsyncGridFS(self.db)
+        self.resumable_uploads = self.db["resumable_uploads"]
+        self.upload_states = self.db["upload_states"]
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+        self.client = self.db = self.collection = self.fs = self.resumable_uploads = self.upload_states = None
+
+    def pool_status(self) -> dict:
+        """
+        接続プールの設定と使用状況を返す。
+        """
+        options = mongo_client_options()
+        return {"pid": os.getpid(), "options": options, **self.pool_stats.snapshot()}
+
+
+mongo = Mongo()
+
+
+def get_db():
+    """FastAPIのDependsで使用するための、現在のデータベースを返す関数"""
+    return mongo.db
@@ -1,12 +1,12 @@
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from pymongo.database import Database
+from pymongo.asynchronous.database import AsyncDatabase
 
 from auth import SECRET_KEY, ALGORITHM
 from schemas import TokenData, User
 from crud.user_crud import get_user_by_email
-from db import db # データベースオブジェクトをインポート
+from db import get_db # データベースを返す依存関数をインポート
 
 # API用の認証スキーム。トークンURLは後で作成するエンドポイントを指す
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/login/token", auto_error=False)
@@ -18,7 +18,7 @@ class NotLoggedInException(Exception):
 async def get_current_user(
     request: Request, 
     token: str = Depends(oauth2_scheme), 
-    db: Database = Depends(lambda: db)
+    db: AsyncDatabase = Depends(get_db)
 ) -> User:
     """
     リクエストからJWTを抽出し、現在のユーザーを返す。
@@ -55,7 +55,7 @@ async def get_current_user(
         is_api_call = "authorization" in request.headers
         raise credentials_exception if is_api_call else NotLoggedInException()
 
-    user = get_user_by_email(db, email=email)
+    user = await get_user_by_email(db, email=email)
     if user is None:
         # トークンは有効だが、該当するユーザーがDBに存在しない場合
         is_api_call = "authorization" in request.headers
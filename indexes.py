@@ -0,0 +1,228 @@
+# indexes.py
+# MongoDBのインデックス定義と、よく使うクエリの実行計画チェックをまとめたファイル。
+# インデックスはアプリ起動時（main.pyのlifespan）に ensure_indexes() で作成される（作成済みの場合は何もしない）。
+#
+# 使用法（リポジトリのルートで実行）:
+#   python indexes.py ensure   # インデックスを作成する
+#   python indexes.py check    # 登録済みのクエリをexplain()し、COLLSCAN（全件走査）になるものを表示する
+#
+# 新しいクエリを追加した場合は、INDEXES と QUERY_SHAPES の両方に追記すること。
+
+import asyncio
+import logging
+import sys
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+from db import mongo
+from services.change_feed import CHANGE_FEED_RETENTION_DAYS
+
+# コレクション名 → 作成するインデックスの一覧
+INDEXES = {
+    "fs.files": [
+        # GridFSが作成するものと同じインデックス（fs.find_one({"filename": ...}) で使用）
+        IndexModel([("filename", ASCENDING), ("uploadDate", ASCENDING)], name="filename_1_uploadDate_1"),
+        # force_reset / temp_files の {temporary: True} 検索、一時画像の自動削除（uploadDate の範囲指定）
+        IndexModel([("temporary", ASCENDING), ("uploadDate", ASCENDING)], name="temporary_1_uploadDate_1"),
+        # 派生画像（/admin/images/{file_id}/resized）の検索。派生画像以外のファイルは索引に含めない
+        # 別のワーカーが同じ派生画像を同時に保存しないよう、一意インデックスにする（services/image_derivatives.py）
+        IndexModel(
+            [("derivative_of", ASCENDING), ("width", ASCENDING), ("format", ASCENDING)],
+            name="derivative_of_1_width_1_format_1",
+            unique=True,
+            partialFilterExpression={"derivative_of": {"$exists": True}},
+        ),
+    ],
+    "images": [
+        # search_unuploaded_items の {group_id, db_uploaded} 検索と (created_at, _id) のキーセットページネーション
+        IndexModel(
+            [("group_id", ASCENDING), ("db_uploaded", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="group_id_1_db_uploaded_1_created_at_-1__id_-1",
+        ),
+        # get_items_for_group の {group_id} 検索と (created_at, _id) のキーセットページネーション
+        IndexModel(
+            [("group_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="group_id_1_created_at_-1__id_-1",
+        ),
+        # export_unuploaded_items の group_id を指定しない {db_uploaded: false} 検索と created_at 順の読み出し
+        IndexModel(
+            [("created_at", ASCENDING), ("_id", ASCENDING)],
+            name="created_at_1__id_1_not_uploaded",
+            partialFilterExpression={"db_uploaded": False},
+        ),
+        # 文字列のまま残っている created_at の検索（services/created_at.py の移行処理）
+        # 移行が終われば対象がなくなるため、文字列のものだけを索引に含める（日時のアイテムで索引が大きくならないようにする）
+        IndexModel(
+            [("created_at", ASCENDING)],
+            name="created_at_1_string",
+            partialFilterExpression={"created_at": {"$type": "string"}},
+        ),
+    ],
+    "resumable_uploads": [
+        # 一時画像の自動削除（services/temp_sweeper.py）で、古いセッションを検索する
+        IndexModel([("created_at", ASCENDING)], name="created_at_1"),
+    ],
+    "upload_states": [
+        # temp_list / temp_delete / finalize_upload は group_id と photographer_id で1件だけを読み書きする
+        IndexModel([("group_id", ASCENDING), ("photographer_id", ASCENDING)], name="group_id_1_photographer_id_1", unique=True),
+        # 一時画像の自動削除で、古い一覧を検索する
+        IndexModel([("updated_at", ASCENDING)], name="updated_at_1"),
+    ],
+    "group_stats": [
+        # /admin/api/groups の last_updated の降順ソート
+        IndexModel([("last_updated", DESCENDING)], name="last_updated_-1"),
+    ],
+    "deletion_jobs": [
+        # /admin/api/deletion_jobs の一覧（新しい順）
+        IndexModel([("created_at", DESCENDING)], name="created_at_-1"),
+        # 同じグループを削除中のジョブの確認
+        IndexModel([("group_id", ASCENDING), ("status", ASCENDING)], name="group_id_1_status_1"),
+        # 終わったジョブは7日後に自動で削除する
+        IndexModel([("finished_at", ASCENDING)], name="finished_at_1", expireAfterSeconds=7 * 24 * 60 * 60),
+    ],
+    "change_events": [
+        # 変更フィードのイベントは _id（連番）で読み出す。保持期間を過ぎたものは自動で削除する
+        # ※ CHANGE_FEED_RETENTION_DAYS を変更した場合は、collMod で既存のインデックスの expireAfterSeconds を変更すること
+        IndexModel([("created_at", ASCENDING)], name="created_at_1", expireAfterSeconds=CHANGE_FEED_RETENTION_DAYS * 24 * 60 * 60),
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_1", unique=True),
+        IndexModel([("role", ASCENDING)], name="role_1"),
+    ],
+}
+
+# 実行計画をチェックするクエリの形（値はダミー。インデックスが使われるかどうかだけを確認する）
+QUERY_SHAPES = [
+    {"name": "GridFS filename lookup", "collection": "fs.files",
+     "filter": {"filename": "x"}},
+    {"name": "finalize_upload temp file check", "collection": "fs.files",
+     "filter": {"_id": {"$in": ["x", "y"]}, "temporary": True}},
+    {"name": "temp_list / temp_delete / finalize_upload upload state", "collection": "upload_states",
+     "filter": {"group_id": "x", "photographer_id": "x"}},
+    {"name": "force_reset temp files", "collection": "fs.files",
+     "filter": {"temporary": True}},
+    {"name": "temp sweeper expired temp files", "collection": "fs.files",
+     "filter": {"temporary": True, "uploadDate": {"$lt": datetime(2000, 1, 1)}}},
+    {"name": "temp sweeper expired upload states", "collection": "upload_states",
+     "filter": {"updated_at": {"$lt": datetime(2000, 1, 1)}}},
+    {"name": "temp sweeper expired resumable uploads", "collection": "resumable_uploads",
+     "filter": {"created_at": {"$lt": datetime(2000, 1, 1)}}},
+    {"name": "image derivative lookup", "collection": "fs.files",
+     "filter": {"derivative_of": "x", "width": 480, "format": "jpeg"}},
+    {"name": "search_unuploaded_items", "collection": "images",
+     "filter": {"group_id": "x", "db_uploaded": False}, "sort": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "get_items_for_group", "collection": "images",
+     "filter": {"group_id": "x"}, "sort": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "get_items_for_group next page", "collection": "images",
+     "filter": {"group_id": "x", "$or": [{"created_at": {"$lt": datetime(2000, 1, 1)}}, {"created_at": datetime(2000, 1, 1), "_id": {"$lt": "x"}}]},
+     "sort": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "get_items_for_group from / to", "collection": "images",
+     "filter": {"group_id": "x", "created_at": {"$gte": datetime(2000, 1, 1), "$lt": datetime(2000, 1, 2)}},
+     "sort": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "search_unuploaded_items from / to", "collection": "images",
+     "filter": {"group_id": "x", "db_uploaded": False, "created_at": {"$gte": datetime(2000, 1, 1), "$lt": datetime(2000, 1, 2)}},
+     "sort": [("created_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "export_unuploaded_items", "collection": "images",
+     "filter": {"db_uploaded": False, "created_at": {"$gte": datetime(2000, 1, 1)}}, "sort": [("created_at", ASCENDING), ("_id", ASCENDING)]},
+    {"name": "export_unuploaded_items by group", "collection": "images",
+     "filter": {"group_id": "x", "db_uploaded": False}, "sort": [("created_at", ASCENDING), ("_id", ASCENDING)]},
+    {"name": "created_at migration", "collection": "images",
+     "filter": {"created_at": {"$type": "string"}}},
+    {"name": "get_groups", "collection": "group_stats",
+     "filter": {}, "sort": [("last_updated", DESCENDING)]},
+    {"name": "group_stats created_at range", "collection": "images",
+     "filter": {"group_id": "x"}, "sort": [("created_at", 1)]},
+    {"name": "deletion job resolve legacy filenames", "collection": "fs.files",
+     "filter": {"filename": {"$in": ["x", "y"]}}},
+    {"name": "deletion job derivatives", "collection": "fs.files",
+     "filter": {"derivative_of": {"$in": ["x", "y"]}}},
+    {"name": "deletion job group items", "collection": "images",
+     "filter": {"group_id": "x"}},
+    {"name": "active group deletion job", "collection": "deletion_jobs",
+     "filter": {"kind": "group", "group_id": "x", "status": "running", "updated_at": {"$gte": datetime(2000, 1, 1)}}},
+    {"name": "get_deletion_jobs", "collection": "deletion_jobs",
+     "filter": {}, "sort": [("created_at", DESCENDING)]},
+    {"name": "change feed read", "collection": "change_events",
+     "filter": {"_id": {"$gt": 0}}, "sort": [("_id", ASCENDING)]},
+    {"name": "get_user_by_email", "collection": "users",
+     "filter": {"email": "x"}},
+    {"name": "get_photographers", "collection": "users",
+     "filter": {"role": "photographer"}},
+]
+
+
+async def ensure_indexes(db):
+    """
+    INDEXES に定義されたインデックスを作成する。作成済みのインデックスはそのまま。
+    1つのコレクションで失敗しても（既存データの重複、接続エラーなど）、アプリの起動は止めない。
+    """
+    for collection_name, models in INDEXES.items():
+        try:
+            await db[collection_name].create_indexes(models)
+        except ConnectionFailure as e:
+            logging.error(f"Failed to create indexes (cannot connect to MongoDB): {e}")
+            return
+        except PyMongoError as e:
+            logging.error(f"Failed to create indexes on {collection_name}: {e}")
+
+
+def find_stages(plan) -> list[str]:
+    """
+    explain()の結果に含まれるステージ名（IXSCAN, COLLSCAN など）をすべて返す。
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(find_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_stages(value))
+    return stages
+
+
+async def check_query_plans(db) -> list[dict]:
+    """
+    QUERY_SHAPES の各クエリをexplain()し、勝者プランのステージと、COLLSCANかどうかを返す。
+    """
+    results = []
+    for shape in QUERY_SHAPES:
+        cursor = db[shape["collection"]].find(shape["filter"])
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        explain = await cursor.explain()
+        stages = find_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        results.append({
+            "name": shape["name"],
+            "collection": shape["collection"],
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+        })
+    return results
+
+
+async def main(command: str) -> int:
+    await mongo.connect()
+    try:
+        if command == "ensure":
+            await ensure_indexes(mongo.db)
+            print("インデックスを作成しました。")
+            return 0
+
+        results = await check_query_plans(mongo.db)
+        for result in results:
+            mark = "NG (COLLSCAN)" if result["collscan"] else "OK"
+            print(f"[{mark}] {result['collection']}: {result['name']} -> {' > '.join(result['stages'])}")
+        return 1 if any(result["collscan"] for result in results) else 0
+    finally:
+        await mongo.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in ("ensure", "check"):
+        print("使用法: python indexes.py ensure|check")
+        sys.exit(1)
+    sys.exit(asyncio.run(main(sys.argv[1])))
@@ -5,11 +5,42 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from contextlib import asynccontextmanager
+import asyncio
 import os
 
 from dependencies import NotLoggedInException # ★ カスタム例外をインポート
-
-app = FastAPI()  # ← この行がないとエラーになる（エントリーポイント）
+from services.process_pool import shutdown_executor
+from db import mongo
+from indexes import ensure_indexes
+from services.group_stats import ensure_group_stats
+from services.temp_sweeper import TEMP_SWEEPER_ENABLED, run_sweeper
+from services.created_at import run_created_at_migration
+from services.upload_state_backfill import run_upload_state_backfill
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # gunicornのワーカーごとにMongoClientを生成する（fork後に接続プールを作るため）
+    await mongo.connect()
+    await ensure_indexes(mongo.db)
+    await ensure_group_stats(mongo.db) # 初回の起動時のみ、グループごとの集計を作成する
+    # 放置された一時画像を定期的に削除するタスク（TEMP_SWEEPER_ENABLED=false で無効）
+    sweeper = asyncio.create_task(run_sweeper()) if TEMP_SWEEPER_ENABLED else None
+    # 文字列で保存された古い created_at を、バックグラウンドで日時に変換する
+    migration = asyncio.create_task(run_created_at_migration())
+    # 撮影中の画像の一覧（upload_states）の導入前にアップロードされた一時画像を、一覧に追加する
+    backfill = asyncio.create_task(run_upload_state_backfill())
+    yield
+    # バックグラウンドのタスクが終わるのを待ってから、MongoClientを閉じる（処理中のバッチが閉じた接続を使わないようにする）
+    tasks = [task for task in (sweeper, migration, backfill) if task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # 終了時にMongoClientと画像処理用のプロセスプールを停止する
+    await mongo.close()
+    shutdown_executor()
+
+app = FastAPI(lifespan=lifespan)  # ← この行がないとエラーになる（エントリーポイント）
 
 # ★ 未ログイン例外のハンドラを登録
 @app.exception_handler(NotLoggedInException)
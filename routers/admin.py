@@ -7,20 +7,27 @@ import json
 import socket
 from typing import List
 
-from fastapi import APIRouter, Form, Request, status, Depends, HTTPException, Response
+from fastapi import APIRouter, Form, Request, status, Depends, HTTPException, Response, Query
 from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-from pymongo import MongoClient
-import gridfs
 from bson import ObjectId
 
-from db import db, collection, fs
+from db import mongo
 from dependencies import get_current_operator
 from schemas import User, UserCreate
 from crud import user_crud
+from services.gridfs_cleanup import delete_gridfs_files_matching
+from services.gridfs_response import gridfs_file_response, IMMUTABLE_CACHE_CONTROL
+from services.thumbnail_cache import thumbnail_cache, cached_thumbnail_response, is_cacheable
+from services.image_derivatives import DERIVATIVE_WIDTHS, DERIVATIVE_FORMATS, derivative_key, get_or_create_derivative
+from services.process_pool import PoolSaturatedError, IMAGE_POOL_RETRY_AFTER
+from services.deletion_jobs import start_group_deletion, start_item_deletion, job_status
+from services.pagination import fetch_page, InvalidPageTokenError, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from services.created_at import created_at_range_filter, InvalidDateRangeError, format_local, isoformat_local
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
+templates.env.filters["local_datetime"] = format_local # created_at（UTC）を日本時間で表示する
 
 TEMP_DIR = "temp_images"
 
@@ -77,11 +84,9 @@ async def show_force_reset_form(request: Request, current_operator: User = Depen
 
 @router.post("/force_reset", response_class=HTMLResponse)
 async def force_reset_images(request: Request, current_operator: User = Depends(get_current_operator)):
-    deleted_count = 0
-    for file in db.fs.files.find({"temporary": True}):
-        fs.delete(file["_id"])
-        deleted_count += 1
-    
+    deleted_count, _ = await delete_gridfs_files_matching(mongo.db, {"temporary": True})
+    await mongo.upload_states.delete_many({})
+
     return templates.TemplateResponse("admin/force_reset.html", {
         "request": request,
         "message": f"{deleted_count} 件の一時画像を削除し、仮登録リストを初期化しました",
@@ -90,26 +95,18 @@ async def force_reset_images(request: Request, current_operator: User = Depends(
 
 @router.get("/statistics", response_class=HTMLResponse)
 async def show_statistics(request: Request, current_operator: User = Depends(get_current_operator)):
-    pipeline = [
-        {"$group": {
-            "_id": "$group_id",
-            "uploaded_count": {"$sum": {"$cond": [{"$eq": ["$db_uploaded", True]}, 1, 0]}},
-            "not_uploaded_count": {"$sum": {"$cond": [{"$eq": ["$db_uploaded", False]}, 1, 0]}},
-            "total_count": {"$sum": 1}
-        }},
-        {"$project": {
-            "group_id": "$_id",
-            "uploaded_count": 1,
-            "not_uploaded_count": 1,
-            "total_count": 1,
-            "upload_percentage": {"$cond": [
-                {"$eq": ["$total_count", 0]}, 0,
-                {"$multiply": [{"$divide": ["$uploaded_count", "$total_count"]}, 100]}
-            ]}
-        }},
-        {"$sort": {"group_id": 1}}
-    ]
-    statistics = list(collection.aggregate(pipeline))
+    # グループごとの集計（group_stats）を読むだけで、images全体の集計は行わない
+    statistics = []
+    async for stat in mongo.db.group_stats.find({}).sort("_id", 1):
+        total_count = stat.get("item_count", 0)
+        statistics.append({
+            "group_id": stat["_id"],
+            "uploaded_count": stat.get("uploaded_count", 0),
+            "not_uploaded_count": stat.get("not_uploaded_count", 0),
+            "total_count": total_count,
+            "total_bytes": stat.get("total_bytes", 0),
+            "upload_percentage": stat.get("uploaded_count", 0) / total_count * 100 if total_count else 0,
+        })
     return templates.TemplateResponse("admin/statistics.html", {
         "request": request,
         "statistics": statistics,
@@ -122,31 +119,78 @@ async def show_search_page(request: Request, current_operator: User = Depends(ge
 
 @router.get("/detail/{item_id}", response_class=HTMLResponse)
 async def show_detail(request: Request, item_id: str, group_id: str = "", date: str = "", current_operator: User = Depends(get_current_operator)):
-    doc = collection.find_one({"_id": ObjectId(item_id)})
+    doc = await mongo.collection.find_one({"_id": ObjectId(item_id)})
     if not doc:
         return templates.TemplateResponse("admin/not_found.html", {"request": request})
 
-    for img in doc.get("images", []):
-        if fn := img.get("filename"):
-            file = fs.find_one({"filename": fn})
-            img["thumbnail_base64"] = base64.b64encode(file.read()).decode() if file else None
-        else:
-            img["thumbnail_base64"] = None
+    # 画像は /admin/images/{file_id}/resized から表示する大きさで読み込ませる。
+    # file_idを保存していない古いアイテムは、ファイル名からまとめて1回で_idを調べる
+    legacy_filenames = [img["filename"] for img in doc.get("images", []) if img.get("filename") and not img.get("file_id")]
+    if legacy_filenames:
+        file_ids = {}
+        async for file in mongo.db.fs.files.find({"filename": {"$in": legacy_filenames}}, {"_id": 1, "filename": 1}):
+            file_ids[file["filename"]] = str(file["_id"])
+        for img in doc["images"]:
+            img["file_id"] = img.get("file_id") or file_ids.get(img.get("filename"))
 
     return templates.TemplateResponse("admin/detail.html", {
-        "request": request, "item": doc, "group_id": group_id, "date": date, "user": current_operator
+        "request": request, "item": doc, "group_id": group_id, "date": date, "user": current_operator,
+        "derivative_widths": DERIVATIVE_WIDTHS
     })
 
+@router.api_route("/images/{file_id}", methods=["GET", "HEAD"])
+async def get_image(request: Request, file_id: str, current_operator: User = Depends(get_current_operator)):
+    """
+    GridFSの画像を_idを指定して返す。同じ_idのファイルの内容は変わらないため、ブラウザに長期間キャッシュさせる。
+    """
+    if not ObjectId.is_valid(file_id):
+        raise HTTPException(status_code=404, detail="Image not found")
+    # キャッシュから返す場合も、先にファイルが存在することを確認する（他のワーカーで削除された画像を返さないため）。
+    # 確認は_idでの1件の検索だけで、チャンクの読み込みはキャッシュにない場合のみ
+    file_doc = await mongo.db.fs.files.find_one({"_id": ObjectId(file_id)})
+    if not file_doc:
+        thumbnail_cache.invalidate([file_id])
+        raise HTTPException(status_code=404, detail="Image not found")
+    if is_cacheable(file_doc):
+        return await cached_thumbnail_response(request, mongo.db, file_doc, IMMUTABLE_CACHE_CONTROL)
+    return await gridfs_file_response(request, mongo.db, file_doc, cache_control=IMMUTABLE_CACHE_CONTROL)
+
+@router.api_route("/images/{file_id}/resized", methods=["GET", "HEAD"])
+async def get_resized_image(request: Request, file_id: str, width: int = 480, format: str = "jpeg", current_operator: User = Depends(get_current_operator)):
+    """
+    GridFSの画像を、指定された幅・形式に縮小して返す。縮小した画像は初回に生成してGridFSに保存し、以降はそれを返す。
+    widthは DERIVATIVE_WIDTHS、formatは DERIVATIVE_FORMATS のいずれか。
+    """
+    if width not in DERIVATIVE_WIDTHS or format not in DERIVATIVE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"width must be one of {list(DERIVATIVE_WIDTHS)}, format must be one of {list(DERIVATIVE_FORMATS)}")
+    if not ObjectId.is_valid(file_id):
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    # 派生画像は元画像と一緒に削除されるため、元画像が存在すればキャッシュ済みの派生画像を返してよい
+    source_doc = await mongo.db.fs.files.find_one({"_id": ObjectId(file_id)})
+    if not source_doc:
+        thumbnail_cache.invalidate([file_id])
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    key = derivative_key(file_id, width, format)
+    if (response := thumbnail_cache.response(request, key, IMMUTABLE_CACHE_CONTROL)) is not None:
+        return response
+    try:
+        derivative_doc = await get_or_create_derivative(mongo.db, mongo.fs, source_doc, width, format)
+    except PoolSaturatedError:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "サーバーが混み合っています。しばらくしてから再度お試しください。"},
+            headers={"Retry-After": str(IMAGE_POOL_RETRY_AFTER)}
+        )
+    return await cached_thumbnail_response(
+        request, mongo.db, derivative_doc, IMMUTABLE_CACHE_CONTROL, key=key, media_type=DERIVATIVE_FORMATS[format][1]
+    )
+
 @router.post("/delete/{item_id}")
 async def delete_item(request: Request, item_id: str, group_id: str = "", date: str = "", current_operator: User = Depends(get_current_operator)):
-    item = collection.find_one({"_id": ObjectId(item_id)})
-    if item and "images" in item:
-        for image_info in item["images"]:
-            if filename := image_info.get("filename"):
-                if file := fs.find_one({"filename": filename}):
-                    fs.delete(file._id)
-    
-    collection.delete_one({"_id": ObjectId(item_id)})
+    # アイテムはすぐに削除し、画像の削除はバックグラウンドのジョブで行う
+    await start_item_deletion(mongo.db, ObjectId(item_id))
     url = f"/admin/search?group_id={group_id}&date={date}&deleted=1"
     return RedirectResponse(url=url, status_code=status.HTTP_303_SEE_OTHER)
 
@@ -154,41 +198,62 @@ async def delete_item(request: Request, item_id: str, group_id: str = "", date:
 
 @router.get("/api/groups")
 async def get_groups(current_operator: User = Depends(get_current_operator)):
-    """グループ一覧と各アイテム数をJSONで返す"""
-    pipeline = [
-        {
-            "$group": {
-                "_id": "$group_id",
-                "item_count": {"$sum": 1},
-                "last_updated": {"$max": "$created_at"},
-                "first_created": {"$min": "$created_at"} # 最初の登録日を追加
-            }
-        },
-        {
-            "$sort": {"last_updated": -1}
-        }
-    ]
-    groups = list(collection.aggregate(pipeline))
+    """グループ一覧と各アイテム数をJSONで返す（group_statsから読む）"""
+    projection = {"item_count": 1, "last_updated": 1, "first_created": 1}
+    groups = await mongo.db.group_stats.find({}, projection).sort("last_updated", -1).to_list()
+    for group in groups:
+        group["first_created"] = isoformat_local(group.get("first_created"))
+        group["last_updated"] = isoformat_local(group.get("last_updated"))
     return JSONResponse(content={"groups": groups})
 
 @router.get("/api/items", response_class=HTMLResponse)
-async def get_items_for_group(request: Request, group_id: str, current_operator: User = Depends(get_current_operator)):
-    """指定されたgroup_idに所属するアイテム一覧をHTMLで返す"""
-    query = {"group_id": group_id}
-    results = list(collection.find(query).sort("created_at", -1))
-    
+async def get_items_for_group(
+    request: Request,
+    group_id: str,
+    page_token: str | None = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    created_from: str | None = Query(None, alias="from"),
+    created_to: str | None = Query(None, alias="to"),
+    current_operator: User = Depends(get_current_operator)
+):
+    """
+    指定されたgroup_idに所属するアイテム一覧を、新しい順にlimit件ずつHTMLで返す。
+    from / to（日付またはISO 8601の日時。タイムゾーンの指定がなければ日本時間）で登録日時を絞り込める。
+    続きがある場合は、次のページのトークンを X-Next-Page-Token ヘッダーで返す（page_tokenに指定する）。
+    """
+    try:
+        query = created_at_range_filter({"group_id": group_id}, created_from, created_to)
+    except InvalidDateRangeError:
+        raise HTTPException(status_code=400, detail="Invalid from / to")
+    projection = {"group_id": 1, "photographer_id": 1, "created_at": 1, "images": 1}
+    try:
+        results, next_page_token = await fetch_page(mongo.collection, query, projection, page_token, limit)
+    except InvalidPageTokenError:
+        raise HTTPException(status_code=400, detail="Invalid page_token")
+
+    # サムネイルは /admin/images/{file_id} から読み込ませる（ブラウザにキャッシュされる）。
+    # サムネイルの_idを保存していない古いアイテムは、ファイル名からまとめて1回で_idを調べる
+    legacy_filenames = [
+        doc["images"][0]["thumbnail_filename"] for doc in results
+        if doc.get("images") and doc["images"][0].get("thumbnail_filename") and not doc["images"][0].get("thumbnail_file_id")
+    ]
+    thumbnail_ids = {}
+    if legacy_filenames:
+        async for file in mongo.db.fs.files.find({"filename": {"$in": legacy_filenames}}, {"_id": 1, "filename": 1}):
+            thumbnail_ids[file["filename"]] = str(file["_id"])
+
     for doc in results:
-        if doc.get("images") and doc["images"][0].get("thumbnail_filename"):
-            # サムネイルファイル名を使ってサムネイル画像を取得
-            file = fs.find_one({"filename": doc["images"][0]["thumbnail_filename"]})
-            doc["thumbnail_base64"] = base64.b64encode(file.read()).decode() if file else None
-        else:
-            doc["thumbnail_base64"] = None
-
-    return templates.TemplateResponse("admin/_search_results.html", {
+        first_image = doc["images"][0] if doc.get("images") else {}
+        doc["thumbnail_file_id"] = first_image.get("thumbnail_file_id") or thumbnail_ids.get(first_image.get("thumbnail_filename"))
+
+    response = templates.TemplateResponse("admin/_search_results.html", {
         "request": request, 
-        "results": results
+        "results": results,
+        "is_first_page": not page_token
     })
+    if next_page_token:
+        response.headers["X-Next-Page-Token"] = next_page_token
+    return response
 
 # --- End Search API Endpoints ---
 
@@ -197,24 +262,24 @@ async def get_items_for_group(request: Request, group_id: str, current_operator:
 
 @router.get("/api/photographers", response_model=List[User])
 async def get_all_photographers(current_operator: User = Depends(get_current_operator)):
-    return user_crud.get_photographers(db)
+    return await user_crud.get_photographers(mongo.db)
 
 @router.post("/api/photographers", response_model=User, status_code=status.HTTP_201_CREATED)
 async def create_new_photographer(user: UserCreate, current_operator: User = Depends(get_current_operator)):
-    db_user = user_crud.get_user_by_email(db, email=user.email)
+    db_user = await user_crud.get_user_by_email(mongo.db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     if user.role != 'photographer':
         raise HTTPException(status_code=400, detail="Role must be 'photographer'")
-    return user_crud.create_user(db=db, user=user)
+    return await user_crud.create_user(db=mongo.db, user=user)
 
 @router.delete("/api/photographers/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_photographer_by_id(user_id: str, current_operator: User = Depends(get_current_operator)):
-    user_to_delete = user_crud.get_user(db, user_id=user_id)
+    user_to_delete = await user_crud.get_user(mongo.db, user_id=user_id)
     if not user_to_delete or user_to_delete.role != 'photographer':
         raise HTTPException(status_code=404, detail="Photographer not found")
     
-    if not user_crud.delete_user_by_id(db, user_id=user_id):
+    if not await user_crud.delete_user_by_id(mongo.db, user_id=user_id):
         raise HTTPException(status_code=500, detail="Failed to delete photographer")
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
@@ -222,27 +287,35 @@ async def delete_photographer_by_id(user_id: str, current_operator: User = Depen
 
 @router.post("/delete_group/{group_id}")
 async def delete_group(request: Request, group_id: str, current_operator: User = Depends(get_current_operator)):
-    items_to_delete = list(collection.find({"group_id": group_id}))
-    deleted_files_count = 0
-    for item in items_to_delete:
-        if "images" in item:
-            for image_info in item["images"]:
-                if filename := image_info.get("filename"):
-                    if file := fs.find_one({"filename": filename}):
-                        fs.delete(file._id)
-                        deleted_files_count += 1
-
-    result = collection.delete_many({"group_id": group_id})
-    deleted_docs_count = result.deleted_count
-
-    return JSONResponse(content={
-        "message": f"グループ '{group_id}' の {deleted_docs_count} 件のドキュメントと {deleted_files_count} 個の画像を削除しました。"
+    """
+    グループの削除ジョブを開始してすぐに返す。進捗は /admin/api/deletion_jobs/{job_id} で確認する。
+    """
+    job_id = await start_group_deletion(mongo.db, group_id)
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={
+        "job_id": str(job_id),
+        "message": f"グループ '{group_id}' の削除を開始しました。"
     })
 
+@router.get("/api/deletion_jobs")
+async def get_deletion_jobs(current_operator: User = Depends(get_current_operator)):
+    """実行中の削除ジョブと、最近終わった削除ジョブを新しい順に返す"""
+    jobs = await mongo.db.deletion_jobs.find({}).sort("created_at", -1).limit(20).to_list()
+    return {"jobs": [job_status(job) for job in jobs]}
+
+@router.get("/api/deletion_jobs/{job_id}")
+async def get_deletion_job(job_id: str, current_operator: User = Depends(get_current_operator)):
+    """削除ジョブの進捗を返す"""
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    job = await mongo.db.deletion_jobs.find_one({"_id": ObjectId(job_id)})
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_status(job)
+
 @router.get("/temp_files")
 async def get_temp_files(current_operator: User = Depends(get_current_operator)):
     files = []
-    for file in db.fs.files.find({"temporary": True}):
+    async for file in mongo.db.fs.files.find({"temporary": True}, {"filename": 1}):
         files.append({"filename": file["filename"]})
     return {"files": files}
 
@@ -1,12 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Response, Form
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.responses import RedirectResponse
-from pymongo.database import Database
+from pymongo.asynchronous.database import AsyncDatabase
 from datetime import timedelta
 
 from auth import verify_password, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES
 from crud.user_crud import get_user_by_email
-from db import db
+from db import get_db
 from schemas import User, Token
 
 router = APIRouter()
@@ -16,13 +16,13 @@ router = APIRouter()
 @router.post("/api/v1/login/token", response_model=Token)
 async def login_for_api(
     form_data: OAuth2PasswordRequestForm = Depends(), 
-    db: Database = Depends(lambda: db)
+    db: AsyncDatabase = Depends(get_db)
 ):
     """
     APIクライアント用のトークン発行エンドポイント。
     ユーザー名とパスワードで認証し、アクセストークンをJSONで返す。
     """
-    user = get_user_by_email(db, email=form_data.username)
+    user = await get_user_by_email(db, email=form_data.username)
     if not user or not verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -42,12 +42,12 @@ async def login_for_api(
 # --- Web Browser Authentication ---
 
 @router.post("/token")
-async def login_for_access_token(response: Response, username: str = Form(...), password: str = Form(...), db: Database = Depends(lambda: db)):
+async def login_for_access_token(response: Response, username: str = Form(...), password: str = Form(...), db: AsyncDatabase = Depends(get_db)):
     """
     ユーザー名（メールアドレス）とパスワードで認証し、役割に応じたページにリダイレクトする。
     認証成功時、アクセストークンはHTTPOnlyのクッキーにセットされる。
     """
-    user = get_user_by_email(db, email=username)
+    user = await get_user_by_email(db, email=username)
     if not user or not verify_password(password, user.hashed_password):
         # 認証失敗時は、エラーメッセージをクエリパラメータに含めてログインページにリダイレクト
         return RedirectResponse(url="/login?error=Incorrect+email+or+password", status_code=status.HTTP_303_SEE_OTHER)
@@ -1,21 +1,28 @@
 # routers/n8n.py
 # ウェブアプリではなく、n8nに対するエンドポイントを提供するためのコードです。 
 
-from fastapi import APIRouter, UploadFile, File, Query, Body, HTTPException
+from fastapi import APIRouter, UploadFile, File, Query, Body, HTTPException, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 
-from pymongo import MongoClient
-import gridfs
 import io
+import json
 
 from pyzbar.pyzbar import decode
 from PIL import Image
 
 from bson import ObjectId
-from typing import Optional
+from pymongo import UpdateOne
+from typing import List, Optional
+from collections import Counter
 from pydantic import BaseModel, Field
 
-from db import db, collection, fs# db.pyから参照するための設定
+from db import mongo # db.pyから参照するための設定
+from services.group_stats import record_uploaded, record_meta_added
+from services.change_feed import append_events, metadata_updated_event, wait_for_events, oldest_seq
+from services.created_at import created_at_range_filter, InvalidDateRangeError, isoformat_local
+from services.pagination import fetch_page, InvalidPageTokenError, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from services.gridfs_response import gridfs_file_response, REVALIDATE_CACHE_CONTROL
+from services.thumbnail_cache import cached_thumbnail_response, is_cacheable
 router = APIRouter()
 
 # MongoDB設定（n8nが外部サーバーからアクセスする想定）
@@ -25,44 +32,127 @@ router = APIRouter()
 #fs = gridfs.GridFS(db)
 
 @router.get("/search_unuploaded_items")
-async def search_unuploaded_items(group_id: str = Query(...)):
+async def search_unuploaded_items(
+    group_id: str = Query(...),
+    page_token: Optional[str] = Query(None),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    created_from: Optional[str] = Query(None, alias="from"),
+    created_to: Optional[str] = Query(None, alias="to")
+):
     """
-    指定されたgroup_idに一致し、かつdb_uploaded == false な商品を返す
+    指定されたgroup_idに一致し、かつdb_uploaded == false な商品を、新しい順にlimit件ずつ返す
+    from / to を指定すると、登録日時（created_at）がその範囲の商品だけを返す
+    続きがある場合は next_page_token を返す（次のリクエストの page_token に指定する）
     """
 
     # group_id一致 & 未アップロードの商品だけ抽出
-    matching_items = collection.find({
+    query = {
         "group_id": group_id,
         "db_uploaded": False
-    })
+    }
+    try:
+        query = created_at_range_filter(query, created_from, created_to)
+    except InvalidDateRangeError:
+        raise HTTPException(status_code=400, detail="Invalid from / to")
+    projection = {"group_id": 1, "photographer_id": 1, "user_short_id": 1, "images": 1, "db_uploaded": 1}
+    try:
+        matching_items, next_page_token = await fetch_page(mongo.collection, query, projection, page_token, limit)
+    except InvalidPageTokenError:
+        raise HTTPException(status_code=400, detail="Invalid page_token")
 
     results = []
     for item in matching_items:
         results.append({
             "_id": str(item["_id"]),
             "group_id": item["group_id"],
-            "user_short_id": item["user_short_id"],
+            # finalize_upload は撮影者を photographer_id に保存する（user_short_id は古いアイテムのみ）
+            "user_short_id": item.get("user_short_id", item.get("photographer_id")),
+            "photographer_id": item.get("photographer_id"),
             "images": item.get("images", []),
-            "db_uploaded": item.get("db_uploaded")
+            "db_uploaded": item.get("db_uploaded"),
+            "created_at": isoformat_local(item.get("created_at"))
         })
 
     if not results:
         return JSONResponse(content={"message": "No unuploaded items found"}, status_code=200)
 
-    return {"items": results}
+    return {"items": results, "next_page_token": next_page_token}
+
+
+EXPORT_BATCH_SIZE = 500 # export_unuploaded_items のカーソルが1回にMongoDBから取得する件数
+# export_unuploaded_items で指定できるフィールド
+EXPORT_FIELDS = {
+    "_id", "group_id", "photographer_id", "images", "created_at", "title", "platform", "description",
+    "jan_code", "status", "quality", "comment", "meta_added", "db_uploaded",
+}
+DEFAULT_EXPORT_FIELDS = "_id,group_id,photographer_id,images,created_at"
+
+
+def export_line(item: dict) -> bytes:
+    """
+    アイテムをNDJSONの1行にする（ObjectIdは文字列、日時は日本時間のISO 8601）。
+    """
+    item["_id"] = str(item["_id"])
+    if "created_at" in item:
+        item["created_at"] = isoformat_local(item["created_at"])
+    return (json.dumps(item, ensure_ascii=False, default=str) + "\n").encode()
+
 
+async def iter_export_lines(cursor):
+    try:
+        async for item in cursor:
+            yield export_line(item)
+    finally:
+        await cursor.close()
+
+
+@router.get("/export_unuploaded_items")
+async def export_unuploaded_items(
+    group_id: Optional[str] = Query(None),
+    since: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1),
+    fields: str = Query(DEFAULT_EXPORT_FIELDS)
+):
+    """
+    db_uploaded == false な商品を、古い順にNDJSON（1行に1件のJSON）で返す。
+    検索結果をメモリにまとめずにカーソルから1件ずつ書き出すため、件数が多くてもメモリ使用量は一定。
+    since を指定すると、登録日時（created_at）がそれ以降の商品だけを返す（前回の最後の created_at を指定すると続きから取得できる。
+    その商品自身も含まれるため、_idで重複を除くこと）。
+    fields には返すフィールドをカンマ区切りで指定する（_id は常に含まれる）。
+    """
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    if unknown := [field for field in requested if field not in EXPORT_FIELDS]:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    query = {"db_uploaded": False}
+    if group_id:
+        query["group_id"] = group_id
+    try:
+        query = created_at_range_filter(query, since, None)
+    except InvalidDateRangeError:
+        raise HTTPException(status_code=400, detail="Invalid since")
 
-@router.get("/images/{filename}")
-async def get_image(filename: str):
+    projection = {"_id": 1, **{field: 1 for field in requested}}
+    cursor = mongo.collection.find(query, projection).sort([("created_at", 1), ("_id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    if limit:
+        cursor = cursor.limit(limit)
+    return StreamingResponse(iter_export_lines(cursor), media_type="application/x-ndjson")
+
+
+@router.api_route("/images/{filename}", methods=["GET", "HEAD"])
+async def get_image(filename: str, request: Request):
     """
     GridFSに保存された画像ファイルを、ファイル名を指定して取得します。
     アクセス例: /n8n/images/sample_001.jpg
+    チャンク単位で返すため、画像のサイズに関わらずメモリ使用量は一定です。Range / ETag（304）に対応します。
     """
-    file = fs.find_one({"filename": filename})
-    if not file:
+    file_doc = await mongo.db.fs.files.find_one({"filename": filename}, sort=[("uploadDate", -1)])
+    if not file_doc:
         return JSONResponse(status_code=404, content={"error": "Image not found"})
 
-    return StreamingResponse(io.BytesIO(file.read()), media_type="image/jpeg")
+    if is_cacheable(file_doc):
+        return await cached_thumbnail_response(request, mongo.db, file_doc, REVALIDATE_CACHE_CONTROL)
+    return await gridfs_file_response(request, mongo.db, file_doc)
 
 
 class MarkUploadedRequest(BaseModel):
@@ -82,15 +172,19 @@ async def mark_item_as_uploaded(request: MarkUploadedRequest):
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid _id format")
 
-    result = collection.update_one(
+    # 更新前のドキュメントを受け取り、実際に未アップロード → アップロード済みになった場合だけ集計を更新する
+    before = await mongo.collection.find_one_and_update(
         {"_id": obj_id},
-        {"$set": {"db_uploaded": True}}
+        {"$set": {"db_uploaded": True}},
+        projection={"group_id": 1, "db_uploaded": 1}
     )
 
-    if result.matched_count == 0:
+    if before is None:
         return JSONResponse(status_code=404, content={"error": "対象アイテムが見つかりません"})
-    if result.modified_count == 0:
+    if before.get("db_uploaded") is True:
         return JSONResponse(status_code=200, content={"message": "すでにdb_uploadedはTrueです"})
+    if before.get("db_uploaded") is False:
+        await record_uploaded(mongo.db, before["group_id"])
 
     return {"message": "更新しました", "_id": request.item_id}
 
@@ -160,13 +254,194 @@ async def update_metadata(request: MetadataUpdateRequest):
     if not update_fields:
         raise HTTPException(status_code=400, detail="更新対象フィールドが指定されていません")
 
-    result = collection.update_one({"_id": obj_id}, {"$set": update_fields})
+    # 更新前の値と比べて、実際に変わった場合だけ変更フィードにイベントを追加する（bulk_update_metadata と同じ）
+    before = await mongo.collection.find_one_and_update(
+        {"_id": obj_id}, {"$set": update_fields}, projection={"group_id": 1, "meta_added": 1, **{key: 1 for key in update_fields}}
+    )
 
-    if result.matched_count == 0:
+    if before is None:
         raise HTTPException(status_code=404, detail="該当するデータが見つかりません")
 
+    # meta_addedが変わった場合は集計を更新する
+    if "meta_added" in update_fields and bool(before.get("meta_added")) != update_fields["meta_added"]:
+        await record_meta_added(mongo.db, before["group_id"], 1 if update_fields["meta_added"] else -1)
+    if any(before.get(key) != value for key, value in update_fields.items()):
+        await append_events(mongo.db, [metadata_updated_event(obj_id, before["group_id"], list(update_fields))])
+
     return {
         "message": "更新しました",
         "_id": request.id,
         "updated_fields": list(update_fields.keys())
-    }
\ No newline at end of file
+    }
+
+# --- 一括更新 ---
+# n8nが1件ずつ mark_uploaded / update_metadata を呼ぶと、件数分のHTTPリクエストと update_one が発生するため、
+# 複数件の更新を1回の bulk_write（ordered=False）で適用するエンドポイントを用意する。
+# bulk_update_metadata の件ごとの matched / modified は、書き込みの直前に1回の検索で読んだ状態から求める（合計はMongoDBの結果）。
+# bulk_mark_uploaded の件ごとの matched / modified も同様。集計（group_stats）に反映する件数は、
+# グループごとの update_many（db_uploaded が False のものだけを更新する）の modified_count を使う。
+
+MAX_BULK_ITEMS = 1000 # 1回のリクエストで更新できる件数の上限
+
+
+class BulkMarkUploadedRequest(BaseModel):
+    ids: List[str]
+
+
+class BulkMetadataUpdateRequest(BaseModel):
+    items: List[MetadataUpdateRequest]
+
+
+def bulk_result(item_id: str, matched: bool = False, modified: bool = False, error: str | None = None) -> dict:
+    result = {"_id": item_id, "matched": matched, "modified": modified}
+    if error:
+        result["error"] = error
+    return result
+
+
+@router.patch("/bulk_mark_uploaded")
+async def bulk_mark_uploaded(request: BulkMarkUploadedRequest):
+    """
+    指定された_idのアイテムのdb_uploadedを、まとめてTrueに更新する。
+    """
+    if len(request.ids) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=400, detail=f"一度に更新できるのは {MAX_BULK_ITEMS} 件までです")
+
+    results, targets = {}, {}
+    for item_id in request.ids:
+        if item_id in results:
+            continue
+        if not ObjectId.is_valid(item_id):
+            results[item_id] = bulk_result(item_id, error="Invalid _id format")
+            continue
+        targets[ObjectId(item_id)] = item_id
+        results[item_id] = bulk_result(item_id, error="対象アイテムが見つかりません")
+
+    if not targets:
+        return {"matched_count": 0, "modified_count": 0, "results": list(results.values())}
+
+    # 存在するか（matched）と更新されるか（modified）は、書き込みの直前に1回の検索で読んだ状態から求める
+    before = await mongo.collection.find({"_id": {"$in": list(targets)}}, {"group_id": 1, "db_uploaded": 1}).to_list()
+    not_uploaded, others = {}, []
+    for doc in before:
+        modified = doc.get("db_uploaded") is not True
+        results[targets[doc["_id"]]] = bulk_result(targets[doc["_id"]], matched=True, modified=modified)
+        if doc.get("db_uploaded") is False:
+            not_uploaded.setdefault(doc["group_id"], []).append(doc["_id"])
+        elif modified:
+            others.append(doc["_id"])
+
+    # db_uploaded が False のものはグループごとにまとめて更新し、実際に更新した件数だけを集計に反映する
+    # （同時に実行された mark_uploaded / bulk_mark_uploaded が先に更新したアイテムは数えない）
+    modified_count = 0
+    for group_id, ids in not_uploaded.items():
+        result = await mongo.collection.update_many({"_id": {"$in": ids}, "db_uploaded": False}, {"$set": {"db_uploaded": True}})
+        modified_count += result.modified_count
+        if result.modified_count:
+            await record_uploaded(mongo.db, group_id, result.modified_count)
+    # db_uploaded がないアイテムは、どちらの件数にも数えられていないため集計は変えない
+    if others:
+        result = await mongo.collection.update_many({"_id": {"$in": others}, "db_uploaded": {"$ne": True}}, {"$set": {"db_uploaded": True}})
+        modified_count += result.modified_count
+
+    return {"matched_count": len(before), "modified_count": modified_count, "results": list(results.values())}
+
+
+@router.patch("/bulk_update_metadata")
+async def bulk_update_metadata(request: BulkMetadataUpdateRequest):
+    """
+    アイテムごとに指定されたメタデータを、まとめて更新する。指定されたフィールドのみ更新。
+    同じ_idが複数回指定された場合は、最初のものだけを適用する。
+    """
+    if len(request.items) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=400, detail=f"一度に更新できるのは {MAX_BULK_ITEMS} 件までです")
+
+    results, patches = {}, {}
+    for patch in request.items:
+        if patch.id in results:
+            continue
+        update_fields = {key: value for key, value in patch.dict().items() if key != "id" and value is not None}
+        if not ObjectId.is_valid(patch.id):
+            results[patch.id] = bulk_result(patch.id, error="Invalid _id format")
+        elif not update_fields:
+            results[patch.id] = bulk_result(patch.id, error="更新対象フィールドが指定されていません")
+        else:
+            patches[ObjectId(patch.id)] = (patch.id, update_fields)
+            results[patch.id] = bulk_result(patch.id, error="該当するデータが見つかりません")
+
+    fields = {key for _, update_fields in patches.values() for key in update_fields}
+    projection = {"group_id": 1, "meta_added": 1, **{key: 1 for key in fields}}
+    before = await mongo.collection.find({"_id": {"$in": list(patches)}}, projection).to_list()
+    meta_added_changes = Counter()
+    operations, events = [], []
+    for doc in before:
+        item_id, update_fields = patches[doc["_id"]]
+        modified = any(doc.get(key) != value for key, value in update_fields.items())
+        results[item_id] = bulk_result(item_id, matched=True, modified=modified)
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": update_fields}))
+        if modified:
+            events.append(metadata_updated_event(doc["_id"], doc["group_id"], list(update_fields)))
+        if "meta_added" in update_fields and bool(doc.get("meta_added")) != update_fields["meta_added"]:
+            meta_added_changes[doc["group_id"]] += 1 if update_fields["meta_added"] else -1
+
+    matched_count, modified_count = 0, 0
+    if operations:
+        result = await mongo.collection.bulk_write(operations, ordered=False)
+        matched_count, modified_count = result.matched_count, result.modified_count
+    for group_id, count in meta_added_changes.items():
+        if count:
+            await record_meta_added(mongo.db, group_id, count)
+    await append_events(mongo.db, events)
+
+    return {"matched_count": matched_count, "modified_count": modified_count, "results": list(results.values())}
+
+
+
+# --- 変更フィード ---
+# 新しく本登録された商品（item_finalized）とメタデータの更新（metadata_updated）を、連番（seq）の順に返す。
+# n8nはグループごとに search_unuploaded_items をポーリングする代わりに、前回の最後の seq を after に指定して待機する。
+
+MAX_CHANGES_TIMEOUT = 60 # ロングポーリングで待つ時間の上限（秒）
+SSE_HEARTBEAT_SECONDS = 15 # イベントがない場合に、接続を保つためのコメントを送る間隔
+
+
+async def changes_response(after: int, events: list[dict], last_seq: int) -> dict:
+    # afterのイベントが保持期間を過ぎて削除されている場合は、取りこぼしがあることを知らせる（export_unuploaded_items で再取得する）
+    oldest = await oldest_seq(mongo.db)
+    return {"events": events, "last_seq": last_seq, "truncated": oldest is not None and after < oldest - 1}
+
+
+@router.get("/changes")
+async def get_changes(
+    after: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    timeout: float = Query(25, ge=0, le=MAX_CHANGES_TIMEOUT),
+    group_id: Optional[str] = Query(None)
+):
+    """
+    連番がafterより後のイベントを返す。イベントがない場合は、追加されるかtimeout秒が経過するまで待つ（ロングポーリング）。
+    次のリクエストでは、レスポンスの last_seq を after に指定する。
+    """
+    events, last_seq = await wait_for_events(mongo.db, after, limit, timeout, group_id)
+    return await changes_response(after, events, last_seq)
+
+
+@router.get("/changes/stream")
+async def stream_changes(request: Request, after: Optional[int] = Query(None, ge=0), group_id: Optional[str] = Query(None)):
+    """
+    イベントを Server-Sent Events で送り続ける。各イベントの id は連番。
+    再接続時は Last-Event-ID ヘッダー（ブラウザやSSEクライアントが自動で付ける）、または after から再開する。
+    """
+    if after is None:
+        last_event_id = request.headers.get("last-event-id", "")
+        after = int(last_event_id) if last_event_id.isdigit() else 0
+
+    async def iter_events(after: int):
+        while not await request.is_disconnected():
+            events, after = await wait_for_events(mongo.db, after, 100, SSE_HEARTBEAT_SECONDS, group_id)
+            if not events:
+                yield ": heartbeat\n\n"
+            for event in events:
+                yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(iter_events(after), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
@@ -2,17 +2,27 @@ import os
 import logging
 import io
 import base64
+import json
+import asyncio
+import re
 from datetime import datetime
 from typing import List
 
 from fastapi import APIRouter, File, UploadFile, Form, Body, Request, Depends, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from PIL import Image
 
-from services.image_processing import process_image, load_and_orient_image_pil, generate_thumbnail
-from services.dummy_image import replace_white_with_color
-from db import db, collection, fs
+from services.image_processing import build_upload_renditions, MAX_IMAGE_SIZE
+from services.upload_ingest import (
+    spool_upload_file, new_spool_path, remove_spool_file, copy_file_to_gridfs, resumable_upload_path,
+    UploadTooLargeError, RESUMABLE_CHUNK_SIZE
+)
+from services.gridfs_cleanup import delete_gridfs_files
+from services.group_stats import record_item_added
+from services.change_feed import append_events, item_finalized_event
+from services.process_pool import run_in_pool, PoolSaturatedError, IMAGE_POOL_WORKERS, IMAGE_POOL_RETRY_AFTER
+from db import mongo, MONGO_USE_TRANSACTIONS
+from bson import ObjectId
 from zoneinfo import ZoneInfo
 
 from dependencies import get_current_photographer
@@ -21,6 +31,13 @@ from schemas import User
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 
+MAX_BATCH_FILES = 10 # temp_upload_batchで一度に受け付ける画像の最大枚数（1商品あたりの最大枚数と同じ）
+
+
+class FinalizeConflictError(Exception):
+    """同じ画像の本登録が別のリクエストで先に行われた場合に発生する例外"""
+    pass
+
 
 @router.get("/upload", response_class=HTMLResponse)
 async def photographer_upload(request: Request, current_photographer: User = Depends(get_current_photographer)):
@@ -39,114 +56,334 @@ async def photographer_upload_old_redirect(request: Request):
     return RedirectResponse(url="/photographer/upload_legacy.html")
 
 
-@router.post("/temp_upload")
-async def temp_upload(
-    file: UploadFile = File(...),
-    group_id: str = Form(...),
-    source_page: str = Form(None),
-    current_photographer: User = Depends(get_current_photographer)
-):
+async def store_temp_upload(image_path: str | None, group_id: str, source_page: str | None, photographer_id: str) -> dict:
+    """
+    一時ファイルに書き出されたアップロード画像を処理し、フルサイズ画像とサムネイルをGridFSに一時保存する。
+    画像処理はプロセスプールで実行する。プールが満杯の場合は PoolSaturatedError を発生させる。
+    temp_uploadと同じ形式のレスポンス用の辞書を返す。
+    """
+    test_mode = os.getenv("TEST_MODE", "False").lower() == "true"
+    output_path = new_spool_path(suffix=".jpeg")
     try:
-        test_mode = os.getenv("TEST_MODE", "False").lower() == "true"
-        photographer_id = current_photographer.id
-
-        if test_mode:
-            await file.read()
-            dummy_image_path = "static/dummy_image.png"
-            img_pil = load_and_orient_image_pil(replace_white_with_color(dummy_image_path, photographer_id))
-        else:
-            contents = await file.read()
-            if source_page == "upload_old":
-                processed_image_bytes, _ = process_image(contents, 0, 0, "auto", "127.0.0.1")
-                if processed_image_bytes is None: processed_image_bytes = contents
-            else:
-                processed_image_bytes = contents
-        
-            img_pil = load_and_orient_image_pil(processed_image_bytes)
-
-        # フルサイズ画像をGridFSに保存 (JPEG形式、品質90)
-        full_image_buffer = io.BytesIO()
-        # 画像モードをJPEG互換のRGBに変換（RGBAの場合は透明部分を白で埋める）
-        if img_pil.mode == 'RGBA':
-            background = Image.new('RGB', img_pil.size, (255, 255, 255)) # 白背景を作成
-            background.paste(img_pil, mask=img_pil.split()[3]) # アルファチャンネルをマスクとして使用
-            img_pil = background
-        elif img_pil.mode != 'RGB':
-            img_pil = img_pil.convert('RGB')
-        img_pil.save(full_image_buffer, format="JPEG", quality=90)
-        full_image_buffer.seek(0)
+        # デコード・トリミング・サムネイル生成・JPEGエンコードはプロセスプールで実行する
+        full_image_path, thumbnail_bytes, was_scaled_down = await run_in_pool(
+            build_upload_renditions, None if test_mode else image_path, output_path, source_page, photographer_id, test_mode
+        )
 
         now = datetime.now(ZoneInfo('Asia/Tokyo'))
         full_filename = f"{group_id}_{photographer_id}_{now.strftime('%Y%m%d%H%M%S%f')}_full.jpeg"
 
-        fs.put(
-            full_image_buffer.getvalue(),
+        # フルサイズ画像をGridFSに保存 (チャンク単位で書き込む)
+        full_file_id = await copy_file_to_gridfs(
+            mongo.fs,
+            full_image_path,
             filename=full_filename,
             group_id=group_id,
             photographer_id=photographer_id,
             temporary=True,
             uploadDate=datetime.utcnow() # Deletion sorting key
         )
+    finally:
+        remove_spool_file(output_path)
+
+    # サムネイル画像をGridFSに保存
+    thumbnail_filename = f"{group_id}_{photographer_id}_{now.strftime('%Y%m%d%H%M%S%f')}_thumb.jpeg"
+
+    thumbnail_file_id = await mongo.fs.put(
+        thumbnail_bytes,
+        filename=thumbnail_filename,
+        group_id=group_id,
+        photographer_id=photographer_id,
+        temporary=True,
+        uploadDate=datetime.utcnow(),
+        is_thumbnail=True # サムネイルであることを示すフラグ
+    )
+
+    # 撮影中の画像の一覧に追加する（並列にアップロードされた場合も、この一覧の順番が撮影順になる）
+    await mongo.upload_states.update_one(
+        {"group_id": group_id, "photographer_id": photographer_id},
+        {
+            "$push": {"files": {
+                "file_id": full_file_id,
+                "filename": full_filename,
+                "thumbnail_file_id": thumbnail_file_id,
+                "thumbnail_filename": thumbnail_filename,
+            }},
+            "$set": {"updated_at": datetime.utcnow()},
+        },
+        upsert=True,
+    )
+
+    # フロントエンドにはサムネイルをBase64で返す
+    thumbnail_b64 = base64.b64encode(thumbnail_bytes).decode()
+
+    return {
+        "thumbnail": thumbnail_b64,
+        "filename": full_filename, # フルサイズ画像のファイル名も返す
+        "thumbnail_filename": thumbnail_filename, # サムネイルのファイル名も返す
+        "is_thumbnail_scaled_down": was_scaled_down # サムネイルが縮小されたかどうかのフラグ
+    }
 
-        # サムネイル画像を生成しGridFSに保存 (JPEG形式、品質85)
-        thumbnail_pil, was_scaled_down = generate_thumbnail(img_pil, max_size=600) # max_sizeは適宜調整
-        thumbnail_buffer = io.BytesIO()
-        # サムネイルもRGBAモードの可能性があるのでRGBに変換
-        if thumbnail_pil.mode == 'RGBA':
-            background = Image.new('RGB', thumbnail_pil.size, (255, 255, 255)) # 白背景を作成
-            background.paste(thumbnail_pil, mask=thumbnail_pil.split()[3]) # アルファチャンネルをマスクとして使用
-            thumbnail_pil = background
-        elif thumbnail_pil.mode != 'RGB':
-            thumbnail_pil = thumbnail_pil.convert('RGB')
-        thumbnail_pil.save(thumbnail_buffer, format="JPEG", quality=85)
-        thumbnail_buffer.seek(0)
-
-        thumbnail_filename = f"{group_id}_{photographer_id}_{now.strftime('%Y%m%d%H%M%S%f')}_thumb.jpeg"
-
-        fs.put(
-            thumbnail_buffer.getvalue(),
-            filename=thumbnail_filename,
-            group_id=group_id,
-            photographer_id=photographer_id,
-            temporary=True,
-            uploadDate=datetime.utcnow(),
-            is_thumbnail=True # サムネイルであることを示すフラグ
-        )
 
-        # フロントエンドにはサムネイルをBase64で返す
-        thumbnail_buffer.seek(0)
-        thumbnail_b64 = base64.b64encode(thumbnail_buffer.getvalue()).decode()
+def pool_saturated_response() -> JSONResponse:
+    logging.warning("Image process pool is saturated. Rejecting upload.")
+    return JSONResponse(
+        status_code=503,
+        content={"error": "サーバーが混み合っています。しばらくしてから再度お試しください。"},
+        headers={"Retry-After": str(IMAGE_POOL_RETRY_AFTER)}
+    )
+
+
+def upload_too_large_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=413,
+        content={"error": f"画像サイズが上限（{MAX_IMAGE_SIZE // (1024 * 1024)}MB）を超えています。"}
+    )
 
-        return {
-            "thumbnail": thumbnail_b64,
-            "filename": full_filename, # フルサイズ画像のファイル名も返す
-            "thumbnail_filename": thumbnail_filename, # サムネイルのファイル名も返す
-            "is_thumbnail_scaled_down": was_scaled_down # サムネイルが縮小されたかどうかのフラグ
-        }
 
+@router.post("/temp_upload")
+async def temp_upload(
+    file: UploadFile = File(...),
+    group_id: str = Form(...),
+    source_page: str = Form(None),
+    current_photographer: User = Depends(get_current_photographer)
+):
+    image_path = None
+    try:
+        test_mode = os.getenv("TEST_MODE", "False").lower() == "true"
+        if not test_mode:
+            # アップロード内容はメモリに載せず、上限サイズを確認しながら一時ファイルへ書き出す
+            image_path = await spool_upload_file(file)
+
+        return await store_temp_upload(image_path, group_id, source_page, current_photographer.id)
+
+    except UploadTooLargeError:
+        return upload_too_large_response()
+    except PoolSaturatedError:
+        return pool_saturated_response()
     except Exception as e:
         logging.error(f"Error in temp_upload: {e}", exc_info=True)
         return JSONResponse(status_code=500, content={"error": str(e)})
+    finally:
+        remove_spool_file(image_path)
+
+async def process_batch_file(index: int, filename: str | None, image_path: str | None, group_id: str, source_page: str | None, photographer_id: str, semaphore: asyncio.Semaphore) -> dict:
+    """
+    temp_upload_batchの1ファイル分の処理を行い、NDJSONの1行分の結果を返す。
+    エラーの場合も例外を発生させず、statusとerrorを含む結果を返す。
+    """
+    result = {"index": index, "original_filename": filename}
+    try:
+        async with semaphore:
+            result.update(await store_temp_upload(image_path, group_id, source_page, photographer_id))
+        result["status"] = 200
+    except PoolSaturatedError:
+        result.update({"status": 503, "error": "サーバーが混み合っています。しばらくしてから再度お試しください。", "retry_after": IMAGE_POOL_RETRY_AFTER})
+    except Exception as e:
+        logging.error(f"Error in temp_upload_batch ({filename}): {e}", exc_info=True)
+        result.update({"status": 500, "error": str(e)})
+    return result
+
+
+@router.post("/temp_upload_batch")
+async def temp_upload_batch(
+    files: List[UploadFile] = File(...),
+    group_id: str = Form(...),
+    source_page: str = Form(None),
+    current_photographer: User = Depends(get_current_photographer)
+):
+    """
+    複数の画像を1回のリクエストで受け取り、並列に処理する。
+    処理が終わったファイルから順に、temp_uploadと同じ項目を含む結果をNDJSON形式で返す。
+    各行の index はリクエスト内でのファイルの順番を表す。
+    """
+    if len(files) > MAX_BATCH_FILES:
+        return JSONResponse(status_code=400, content={"error": f"一度にアップロードできる画像は{MAX_BATCH_FILES}枚までです。"})
+
+    test_mode = os.getenv("TEST_MODE", "False").lower() == "true"
+    photographer_id = current_photographer.id
+
+    # レスポンスのストリーミング中にUploadFileが閉じられても良いように、先に一時ファイルへ書き出しておく
+    spooled = []
+    for index, file in enumerate(files):
+        try:
+            image_path = None if test_mode else await spool_upload_file(file)
+            spooled.append((index, file.filename, image_path, None))
+        except UploadTooLargeError:
+            spooled.append((index, file.filename, None, f"画像サイズが上限（{MAX_IMAGE_SIZE // (1024 * 1024)}MB）を超えています。"))
+        except BaseException:
+            for _, _, image_path, _ in spooled:
+                remove_spool_file(image_path)
+            raise
+
+    async def results():
+        # 1リクエストでプロセスプールの待ち行列を埋め尽くさないよう、同時実行数をワーカー数までに制限する
+        semaphore = asyncio.Semaphore(IMAGE_POOL_WORKERS)
+        tasks = []
+        try:
+            for index, filename, image_path, error in spooled:
+                if error is not None:
+                    yield json.dumps({"index": index, "original_filename": filename, "status": 413, "error": error}, ensure_ascii=False) + "\n"
+                    continue
+                tasks.append(asyncio.create_task(
+                    process_batch_file(index, filename, image_path, group_id, source_page, photographer_id, semaphore)
+                ))
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task, ensure_ascii=False) + "\n"
+        finally:
+            # クライアントが切断した場合は残りの処理を中止する
+            for task in tasks:
+                task.cancel()
+            for _, _, image_path, _ in spooled:
+                remove_spool_file(image_path)
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+# --- Resumable Upload APIs ---
+# 混雑したWi-Fiでも途中から再送できるように、画像を分割して送信するためのAPI。
+# 1. POST   /upload_sessions                  : アップロードセッションを作成する
+# 2. PUT    /upload_sessions/{upload_id}       : Content-Rangeで指定した範囲のバイト列を送信する
+# 3. GET    /upload_sessions/{upload_id}       : 受信済みのバイト数（offset）を確認する
+# 4. POST   /upload_sessions/{upload_id}/finalize : 受信を完了し、temp_uploadと同じ処理を行う
+# 受信途中のデータはローカルディスク（UPLOAD_SPOOL_DIR）に、セッション情報はMongoDBに保存する。
+
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+
+
+async def find_resumable_upload(upload_id: str, photographer_id: str) -> dict | None:
+    try:
+        obj_id = ObjectId(upload_id)
+    except Exception:
+        return None
+    return await mongo.resumable_uploads.find_one({"_id": obj_id, "photographer_id": photographer_id})
+
+
+@router.post("/upload_sessions", status_code=201)
+async def create_upload_session(data: dict = Body(...), current_photographer: User = Depends(get_current_photographer)):
+    group_id = data.get("group_id")
+    size = data.get("size")
+    if not group_id or not isinstance(size, int) or size <= 0:
+        return JSONResponse(status_code=400, content={"error": "Invalid params"})
+    if size > MAX_IMAGE_SIZE:
+        return upload_too_large_response()
+
+    upload_id = ObjectId()
+    open(resumable_upload_path(str(upload_id)), "wb").close()
+    await mongo.resumable_uploads.insert_one({
+        "_id": upload_id,
+        "group_id": group_id,
+        "photographer_id": current_photographer.id,
+        "source_page": data.get("source_page"),
+        "size": size,
+        "offset": 0,
+        "created_at": datetime.utcnow()
+    })
+    return {"upload_id": str(upload_id), "offset": 0, "size": size, "chunk_size": RESUMABLE_CHUNK_SIZE}
+
+
+@router.get("/upload_sessions/{upload_id}")
+async def get_upload_session(upload_id: str, current_photographer: User = Depends(get_current_photographer)):
+    session = await find_resumable_upload(upload_id, current_photographer.id)
+    if not session:
+        return JSONResponse(status_code=404, content={"error": "アップロードセッションが見つかりません"})
+    return {"upload_id": upload_id, "offset": session["offset"], "size": session["size"]}
+
+
+@router.put("/upload_sessions/{upload_id}")
+async def put_upload_chunk(upload_id: str, request: Request, current_photographer: User = Depends(get_current_photographer)):
+    session = await find_resumable_upload(upload_id, current_photographer.id)
+    if not session:
+        return JSONResponse(status_code=404, content={"error": "アップロードセッションが見つかりません"})
+
+    match = CONTENT_RANGE_PATTERN.fullmatch(request.headers.get("content-range", ""))
+    if not match:
+        return JSONResponse(status_code=400, content={"error": "Content-Rangeヘッダーが不正です"})
+    start, end, total = (int(v) for v in match.groups())
+    if total != session["size"] or end < start or end >= total:
+        return JSONResponse(status_code=416, content={"error": "Content-Rangeの範囲が不正です", "offset": session["offset"]})
+    if start != session["offset"]:
+        # 受信済みの位置と一致しない場合は、クライアントに正しい位置から再送してもらう
+        return JSONResponse(status_code=409, content={"error": "送信位置が受信済みのバイト数と一致しません", "offset": session["offset"]})
+
+    # 受信したバイト列をファイルの該当位置に書き込む（範囲を超える分は受け付けない）
+    expected = end - start + 1
+    received = 0
+    with open(resumable_upload_path(upload_id), "r+b") as f:
+        f.seek(start)
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > expected:
+                return JSONResponse(status_code=400, content={"error": "本文がContent-Rangeより長すぎます", "offset": session["offset"]})
+            f.write(chunk)
+    if received != expected:
+        # 途中で切断された場合などは、書き込んだ分をコミットしない
+        return JSONResponse(status_code=400, content={"error": "本文がContent-Rangeより短すぎます", "offset": session["offset"]})
+
+    # 他のリクエストが先にコミットしていない場合のみoffsetを進める
+    await mongo.resumable_uploads.update_one({"_id": session["_id"], "offset": start}, {"$set": {"offset": end + 1}})
+    session = await mongo.resumable_uploads.find_one({"_id": session["_id"]}, {"offset": 1})
+    return {"upload_id": upload_id, "offset": session["offset"], "size": total}
+
+
+@router.post("/upload_sessions/{upload_id}/finalize")
+async def finalize_upload_session(upload_id: str, current_photographer: User = Depends(get_current_photographer)):
+    session = await find_resumable_upload(upload_id, current_photographer.id)
+    if not session:
+        return JSONResponse(status_code=404, content={"error": "アップロードセッションが見つかりません"})
+    if session["offset"] != session["size"]:
+        return JSONResponse(status_code=409, content={"error": "まだすべてのデータを受信していません", "offset": session["offset"]})
+
+    # finalizeが二重に実行されて画像が重複登録されないよう、セッションを処理中にする
+    claimed = await mongo.resumable_uploads.update_one({"_id": session["_id"], "finalizing": {"$ne": True}}, {"$set": {"finalizing": True}})
+    if claimed.modified_count == 0:
+        return JSONResponse(status_code=409, content={"error": "このアップロードは処理中です"})
+
+    try:
+        result = await store_temp_upload(resumable_upload_path(upload_id), session["group_id"], session.get("source_page"), current_photographer.id)
+    except Exception as e:
+        # セッションは残しておき、クライアントにはfinalizeだけを再試行してもらう
+        await mongo.resumable_uploads.update_one({"_id": session["_id"]}, {"$set": {"finalizing": False}})
+        if isinstance(e, PoolSaturatedError):
+            return pool_saturated_response()
+        logging.error(f"Error in finalize_upload_session: {e}", exc_info=True)
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    await mongo.resumable_uploads.delete_one({"_id": session["_id"]})
+    remove_spool_file(resumable_upload_path(upload_id))
+    return result
+
+
+@router.delete("/upload_sessions/{upload_id}")
+async def delete_upload_session(upload_id: str, current_photographer: User = Depends(get_current_photographer)):
+    session = await find_resumable_upload(upload_id, current_photographer.id)
+    if not session:
+        return JSONResponse(status_code=404, content={"error": "アップロードセッションが見つかりません"})
+    await mongo.resumable_uploads.delete_one({"_id": session["_id"]})
+    remove_spool_file(resumable_upload_path(upload_id))
+    return {"deleted": upload_id}
+
+# --- End Resumable Upload APIs ---
 
 @router.post("/temp_delete")
 async def temp_delete(data: dict = Body(...), current_photographer: User = Depends(get_current_photographer)):
     group_id = data.get("group_id")
     photographer_id = current_photographer.id
 
-    # Find the most recently uploaded temporary file for this user and group
-    latest_file = fs.find_one({
-        "group_id": group_id,
-        "photographer_id": photographer_id,
-        "temporary": True
-    }, sort=[("uploadDate", -1)])
+    # 撮影中の画像の一覧から最後の1枚を取り出す（更新前のドキュメントの最後の要素が対象）
+    state = await mongo.upload_states.find_one_and_update(
+        {"group_id": group_id, "photographer_id": photographer_id, "files.0": {"$exists": True}},
+        {"$pop": {"files": 1}, "$set": {"updated_at": datetime.utcnow()}},
+        projection={"files": {"$slice": -1}},
+    )
 
-    if not latest_file:
+    if not state:
         return JSONResponse(status_code=404, content={"error": "削除対象の画像が見つかりません"})
 
-    # Delete from GridFS
-    fs.delete(latest_file._id)
+    # フルサイズ画像とサムネイルをGridFSから削除
+    latest_file = state["files"][0]
+    await delete_gridfs_files(mongo.db, [latest_file["file_id"], latest_file["thumbnail_file_id"]], extra_filter={"temporary": True})
 
-    return {"deleted": latest_file.filename}
+    return {"deleted": latest_file["filename"]}
 
 @router.post("/finalize_upload")
 async def finalize_upload(data: dict = Body(...), current_photographer: User = Depends(get_current_photographer)):
@@ -159,39 +396,95 @@ async def finalize_upload(data: dict = Body(...), current_photographer: User = D
     if not group_id or not filenames_data:
         return JSONResponse(status_code=400, content={"error": "Invalid params"})
 
-    try:
-        images = []
-        for item_data in filenames_data:
-            full_filename = item_data.get("filename")
-            thumbnail_filename = item_data.get("thumbnail_filename")
-
-            # フルサイズ画像をtemporary: Falseに更新
-            file = fs.find_one({"filename": full_filename, "photographer_id": photographer_id, "temporary": True})
-            if file:
-                db.fs.files.update_one({"_id": file._id}, {"$set": {"temporary": False}})
-                images.append({"filename": full_filename, "thumbnail_filename": thumbnail_filename, "file_id": str(file._id)})
-            
-            # サムネイル画像をtemporary: Falseに更新
-            thumb_file = fs.find_one({"filename": thumbnail_filename, "photographer_id": photographer_id, "temporary": True})
-            if thumb_file:
-                db.fs.files.update_one({"_id": thumb_file._id}, {"$set": {"temporary": False}})
+    full_filenames = [item_data.get("filename") for item_data in filenames_data]
+    thumbnail_filenames = {item_data.get("filename"): item_data.get("thumbnail_filename") for item_data in filenames_data}
+    requested = [name for item_data in filenames_data for name in (item_data.get("filename"), item_data.get("thumbnail_filename")) if name]
+    state_key = {"group_id": group_id, "photographer_id": photographer_id}
 
+    try:
+        # 撮影中の画像の一覧から、ファイル名に対応するGridFSの_idを取得する
+        state = await mongo.upload_states.find_one(state_key, {"files": 1})
+        file_ids = {}
+        for entry in (state or {}).get("files", []):
+            file_ids[entry["filename"]] = entry["file_id"]
+            file_ids[entry["thumbnail_filename"]] = entry["thumbnail_file_id"]
+
+        # 一時画像として残っているものだけを対象にする（自動削除などで消えている場合があるため）
+        existing = {
+            file["_id"]: file["length"]
+            async for file in mongo.db.fs.files.find(
+                {"_id": {"$in": [file_ids[name] for name in requested if name in file_ids]}, "temporary": True},
+                {"_id": 1, "length": 1},
+            )
+        }
+        found = {name: file_ids[name] for name in requested if file_ids.get(name) in existing}
+        missing = [name for name in requested if name not in found]
+
+        # 画像の順番はリクエストの順番（撮影順）のまま
+        images = [
+            {
+                "filename": name,
+                "thumbnail_filename": thumbnail_filenames[name],
+                "file_id": str(found[name]),
+                "thumbnail_file_id": str(found[thumbnail_filenames[name]]) if thumbnail_filenames[name] in found else None,
+            }
+            for name in full_filenames if name in found
+        ]
         if not images:
-             return JSONResponse(status_code=404, content={"error": "登録対象の画像が見つかりませんでした。"})
+            return JSONResponse(status_code=404, content={"error": "登録対象の画像が見つかりませんでした。", "missing": missing})
 
-        collection.insert_one({
+        item = {
             "group_id": group_id,
             "photographer_id": photographer_id,
             "images": images,
             "title": "", "platform": "", "description": "", "jan_code": "",
-            "created_at": datetime.now(ZoneInfo('Asia/Tokyo')).strftime("%Y-%m-%d %H:%M:%S.%f")[:-4],
+            "created_at": datetime.utcnow(), # BSONの日時（UTC）で保存する。表示時に日本時間に変換する
             "quality": quality,
             "comment": comment,
             "meta_added": False,
             "db_uploaded": False
-        })
+        }
 
-        return {"success": True}
+        async def promote(session=None):
+            # temporary: False への更新を先に行う。途中で失敗しても、本登録済みの商品の画像が
+            # 一時画像として自動削除されることはない（残った画像は孤立ファイルとして扱う）
+            promote_ids = list(found.values())
+            finalize_token = ObjectId() # このリクエストが本登録した画像の印
+            result = await mongo.db.fs.files.update_many(
+                {"_id": {"$in": promote_ids}, "temporary": True},
+                {"$set": {"temporary": False, "finalize_token": finalize_token}},
+                session=session,
+            )
+            if result.modified_count != len(promote_ids):
+                # 同じ画像を同時に本登録した別のリクエストが先に更新した。商品を二重に登録しないよう、
+                # このリクエストが本登録した画像だけを一時画像に戻して中止する
+                await mongo.db.fs.files.update_many(
+                    {"_id": {"$in": promote_ids}, "finalize_token": finalize_token},
+                    {"$set": {"temporary": True}, "$unset": {"finalize_token": ""}},
+                    session=session,
+                )
+                raise FinalizeConflictError()
+            await mongo.collection.insert_one(item, session=session)
+            await record_item_added(mongo.db, item, sum(existing[file_id] for file_id in found.values()), session=session)
+            # 外部システムへの変更フィードに、本登録されたことを追加する
+            await append_events(mongo.db, [item_finalized_event(item)], session=session)
+            # 本登録した画像を撮影中の一覧から外す
+            await mongo.upload_states.update_one(
+                state_key,
+                {"$pull": {"files": {"filename": {"$in": [image["filename"] for image in images]}}}, "$set": {"updated_at": datetime.utcnow()}},
+                session=session,
+            )
+
+        if MONGO_USE_TRANSACTIONS:
+            # レプリカセット構成の場合は、画像の更新と商品の登録を1つのトランザクションで行う
+            async with mongo.client.start_session() as session:
+                await session.with_transaction(promote)
+        else:
+            await promote()
+
+        return {"success": True, "missing": missing}
+    except FinalizeConflictError:
+        return JSONResponse(status_code=409, content={"error": "これらの画像は別のリクエストで本登録されています。"})
     except Exception as e:
         logging.error(f"Error in finalize_upload: {e}", exc_info=True)
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -204,17 +497,10 @@ async def get_temp_list(group_id: str, current_photographer: User = Depends(get_
     logging.info(f"Searching for group_id: {group_id}")
     logging.info(f"Searching for photographer_id: {photographer_id}")
 
-    query = {
-        "group_id": group_id,
-        "photographer_id": photographer_id,
-        "temporary": True
-    }
+    # 撮影中の画像の一覧（フルサイズ画像とサムネイルのファイル名を撮影順に並べる）
+    state = await mongo.upload_states.find_one({"group_id": group_id, "photographer_id": photographer_id}, {"files": 1})
+    files = [name for entry in (state or {}).get("files", []) for name in (entry["filename"], entry["thumbnail_filename"])]
 
-    # Query GridFS and create a list of filenames
-    files_cursor = fs.find(query)
-    files = [file.filename for file in files_cursor]
-    
-    logging.info(f"Found {len(files)} files in GridFS with query: {query}")
     logging.info(f"Returning file list: {files}")
     logging.info("--- temp_list finished ---")
     
@@ -4,6 +4,8 @@ from fastapi.templating import Jinja2Templates
 
 from dependencies import get_current_system_admin
 from schemas import User
+from db import mongo
+from services.thumbnail_cache import thumbnail_cache
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
@@ -22,3 +24,18 @@ async def read_users_me(current_user: User = Depends(get_current_system_admin)):
     現在ログインしているシステム管理者の情報を返す。
     """
     return current_user
+
+@router.get("/api/mongo_pool")
+async def get_mongo_pool_status(current_user: User = Depends(get_current_system_admin)):
+    """
+    このワーカーのMongoDB接続プールの設定と使用状況（貸し出し中の接続数、待ち時間など）を返す。
+    gunicornのワーカーごとに値が異なるため、pidも合わせて返す。
+    """
+    return mongo.pool_status()
+
+@router.get("/api/thumbnail_cache")
+async def get_thumbnail_cache_status(current_user: User = Depends(get_current_system_admin)):
+    """
+    このワーカーのサムネイルキャッシュの使用状況（ヒット数、ミス数、追い出し数など）を返す。
+    """
+    return thumbnail_cache.stats()
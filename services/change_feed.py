@@ -0,0 +1,154 @@
+# change_feed.py
+# 新しく本登録された商品やメタデータの更新を、外部システム（n8n）に通知するための変更フィード（outbox）。
+# 書き込みと同じ処理の中で change_events コレクションに連番付きのイベントを追加し、
+# 外部APIは「指定された連番より後のイベント」をロングポーリング / Server-Sent Events で返す。
+# MongoDBのChange Streamsはレプリカセットが必要なため使わない（単体のmongodでも動作する）。
+#
+# 連番は counters コレクションの $inc で払い出す。払い出しとイベントの追加の間に他の書き込みが追い越すことがあるため、
+# 読み出し側は連番が抜けている位置で止まり、抜けが CHANGE_FEED_GAP_WAIT_SECONDS 以上埋まらない場合だけ飛ばす
+# （書き込みの失敗とみなし、飛ばした連番はログに出力する）。飛ばす直前に抜けている範囲を読み直し、その間に追加されたイベントは飛ばさない。
+# MONGO_USE_TRANSACTIONS=true の場合は、連番の払い出しとイベントの追加を1つのトランザクションで行うため、
+# 失敗した書き込みが抜けを残すことはない（抜けは書き込み中の短い間だけになる）。
+#
+# ※ 配信は「最大1回」（at-most-once）。トランザクションを使わない構成（MONGO_USE_TRANSACTIONS=false）で、
+#    本来の書き込みの後、イベントの追加の前にワーカーが停止した場合や、抜けが待ち時間を過ぎてから埋まった場合、
+#    そのイベントは配信されない。取りこぼしが許されない場合は、定期的に export_unuploaded_items で突き合わせること。
+#
+# 環境変数で設定できる項目:
+#   CHANGE_FEED_RETENTION_DAYS    : イベントを保持する日数。古いものはTTLインデックスで自動削除される（既定: 7）
+#   CHANGE_FEED_GAP_WAIT_SECONDS  : 連番の抜けが埋まるのを待つ秒数。抜けがある間は、それより後のイベントの配信が
+#                                   すべての利用者で止まるため、通常の書き込みにかかる時間より少し長い程度にする（既定: 5）
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.asynchronous.database import AsyncDatabase
+
+from db import MONGO_USE_TRANSACTIONS
+from services.created_at import isoformat_local
+
+CHANGE_FEED_RETENTION_DAYS = int(os.environ.get("CHANGE_FEED_RETENTION_DAYS", "7"))
+CHANGE_FEED_GAP_WAIT_SECONDS = float(os.environ.get("CHANGE_FEED_GAP_WAIT_SECONDS", "5"))
+
+COUNTER_ID = "change_events"
+POLL_INTERVAL_SECONDS = 0.5 # 他のワーカーが追加したイベントを確認する間隔
+
+# 同じワーカーでイベントが追加されたときに、待機中のリクエストをすぐに起こすためのイベント
+_wakeup: asyncio.Event | None = None
+
+
+def notify():
+    global _wakeup
+    if _wakeup is not None:
+        _wakeup.set()
+    _wakeup = asyncio.Event()
+
+
+async def wait_for_notification(timeout: float):
+    """
+    同じワーカーでイベントが追加されるか、timeout秒が経過するまで待つ。
+    """
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    try:
+        await asyncio.wait_for(_wakeup.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def append_events(db: AsyncDatabase, events: list[dict], session=None):
+    """
+    イベントに連番を付けて change_events に追加する。eventsの各要素は type と、イベントの内容を持つ辞書。
+    sessionを指定した場合は、呼び出し元のトランザクションの中で追加する。
+    指定しない場合、MONGO_USE_TRANSACTIONS=true であれば、連番の払い出しと追加だけのトランザクションで行う。
+    """
+    if not events:
+        return
+    if session is None and MONGO_USE_TRANSACTIONS:
+        async with db.client.start_session() as own_session:
+            await own_session.with_transaction(lambda s: insert_events(db, events, s))
+    else:
+        await insert_events(db, events, session)
+    notify()
+
+
+async def insert_events(db: AsyncDatabase, events: list[dict], session):
+    counter = await db.counters.find_one_and_update(
+        {"_id": COUNTER_ID},
+        {"$inc": {"seq": len(events)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+    first_seq = counter["seq"] - len(events) + 1
+    now = datetime.utcnow()
+    await db.change_events.insert_many(
+        [{**event, "_id": first_seq + i, "created_at": now} for i, event in enumerate(events)],
+        session=session,
+    )
+
+
+def item_finalized_event(item: dict) -> dict:
+    return {
+        "type": "item_finalized",
+        "item_id": item["_id"],
+        "group_id": item["group_id"],
+        "photographer_id": item.get("photographer_id"),
+    }
+
+
+def metadata_updated_event(item_id, group_id: str, fields: list[str]) -> dict:
+    return {"type": "metadata_updated", "item_id": item_id, "group_id": group_id, "fields": fields}
+
+
+def event_json(event: dict) -> dict:
+    """
+    イベントをAPIで返す形式にする（_id は seq として返す）。
+    """
+    result = {key: value for key, value in event.items() if key != "_id"}
+    result.update(seq=event["_id"], item_id=str(event["item_id"]), created_at=isoformat_local(event["created_at"]))
+    return result
+
+
+async def read_events(db: AsyncDatabase, after: int, limit: int, group_id: str | None = None) -> tuple[list[dict], int]:
+    """
+    連番がafterより後のイベントを、連番の抜けがない範囲でlimit件まで返す。
+    返したイベントと、次に after に指定する連番を返す（group_idで絞り込んだ場合も、読み飛ばした分だけ進む）。
+    """
+    events = await db.change_events.find({"_id": {"$gt": after}}).sort("_id", 1).limit(limit).to_list()
+    results, last_seq = [], after
+    for event in events:
+        if event["_id"] != last_seq + 1:
+            if event["created_at"] > datetime.utcnow() - timedelta(seconds=CHANGE_FEED_GAP_WAIT_SECONDS):
+                break # 前の連番のイベントがまだ追加されていない可能性がある
+            if await db.change_events.find_one({"_id": {"$gt": last_seq, "$lt": event["_id"]}}, {"_id": 1}) is not None:
+                break # 読み出した後に抜けが埋まった。次の読み出しで返す
+            for seq in range(last_seq + 1, event["_id"]):
+                logging.warning(f"Change feed: skipped seq {seq} (not written within {CHANGE_FEED_GAP_WAIT_SECONDS} seconds)")
+        last_seq = event["_id"]
+        if group_id is None or event["group_id"] == group_id:
+            results.append(event_json(event))
+    return results, last_seq
+
+
+async def oldest_seq(db: AsyncDatabase) -> int | None:
+    event = await db.change_events.find_one({}, {"_id": 1}, sort=[("_id", 1)])
+    return event["_id"] if event else None
+
+
+async def wait_for_events(db: AsyncDatabase, after: int, limit: int, timeout: float, group_id: str | None = None) -> tuple[list[dict], int]:
+    """
+    afterより後のイベントがあればすぐに返し、なければtimeout秒まで待つ（ロングポーリング）。
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        events, last_seq = await read_events(db, after, limit, group_id)
+        remaining = deadline - asyncio.get_running_loop().time()
+        if events or remaining <= 0:
+            return events, last_seq
+        after = last_seq
+        await wait_for_notification(min(POLL_INTERVAL_SECONDS, remaining))
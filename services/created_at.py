@@ -0,0 +1,183 @@
+# created_at.py
+# images の created_at は BSON の日時（UTC）で保存する。
+# 以前は日本時間の文字列（"%Y-%m-%d %H:%M:%S.%f" の末尾4桁を切り捨てたもの）で保存していたため、
+# 範囲検索にインデックス（group_id, created_at）が使えなかった。
+#
+# 文字列のまま残っているアイテムは、アプリの起動時にバックグラウンドで少しずつ日時に変換する（オンライン移行）。
+# 複数のgunicornワーカーが同時に変換しないよう、job_locksコレクションのロックを取得したワーカーだけが実行する。
+# cronなどから手動で実行する場合は、以下のコマンドを使用する:
+#   python -m services.created_at
+#
+# 環境変数で設定できる項目:
+#   CREATED_AT_MIGRATION_BATCH_SIZE    : 1回に変換するアイテム数（既定: 500）
+#   CREATED_AT_MIGRATION_PAUSE_SECONDS : バッチごとの待ち時間。通常の処理への影響を抑える（既定: 0.1）
+
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from pymongo import UpdateOne
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import PyMongoError
+
+from db import mongo
+from services.group_stats import rebuild_group_stats
+from services.temp_sweeper import acquire_lock
+
+CREATED_AT_MIGRATION_BATCH_SIZE = int(os.environ.get("CREATED_AT_MIGRATION_BATCH_SIZE", "500"))
+CREATED_AT_MIGRATION_PAUSE_SECONDS = float(os.environ.get("CREATED_AT_MIGRATION_PAUSE_SECONDS", "0.1"))
+
+LOCAL_TZ = ZoneInfo("Asia/Tokyo")
+LEGACY_FORMATS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S")
+LOCK_ID = "created_at_migration"
+LOCK_SECONDS = 600
+
+
+class InvalidDateRangeError(Exception):
+    """from / to の形式が正しくない場合に発生する例外"""
+    pass
+
+
+def parse_legacy_created_at(value: str) -> datetime | None:
+    """
+    文字列で保存された created_at（日本時間）を、UTCの日時（tzinfoなし。pymongoが保存する形式）に変換する。
+    解釈できない場合はNoneを返す。
+    """
+    for fmt in LEGACY_FORMATS:
+        try:
+            local = datetime.strptime(value, fmt).replace(tzinfo=LOCAL_TZ)
+        except ValueError:
+            continue
+        return local.astimezone(timezone.utc).replace(tzinfo=None)
+    return None
+
+
+def to_local(value):
+    """
+    created_at（UTCの日時）を日本時間の日時に変換する。移行前の文字列はそのまま返す。
+    """
+    if not isinstance(value, datetime):
+        return value
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(LOCAL_TZ)
+
+
+def format_local(value) -> str:
+    """
+    created_at を画面に表示する文字列（日本時間）にする。テンプレートのフィルター local_datetime として使う。
+    """
+    if value is None:
+        return ""
+    if not isinstance(value, datetime):
+        return str(value)
+    return to_local(value).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def isoformat_local(value):
+    """
+    created_at をJSONで返す形式（日本時間のISO 8601）にする。
+    """
+    if not isinstance(value, datetime):
+        return value
+    return to_local(value).isoformat()
+
+
+def parse_range_bound(value: str, is_end: bool) -> datetime:
+    """
+    from / to に指定された値を、UTCの日時に変換する。
+    "2024-05-01" のような日付だけの場合、to はその日の終わりまで（翌日の0時より前）を含む。
+    タイムゾーンの指定がない場合は日本時間として扱う。
+    """
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError as e:
+        raise InvalidDateRangeError(value) from e
+    if is_end and len(value) == 10:
+        parsed += timedelta(days=1)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=LOCAL_TZ)
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def created_at_range_filter(query: dict, created_from: str | None, created_to: str | None) -> dict:
+    """
+    queryに created_at の範囲（from以上、to未満）の条件を追加する。
+    形式が正しくない場合は InvalidDateRangeError を発生させる。
+    """
+    condition = {}
+    if created_from:
+        condition["$gte"] = parse_range_bound(created_from, is_end=False)
+    if created_to:
+        condition["$lt"] = parse_range_bound(created_to, is_end=True)
+    if not condition:
+        return query
+    return {**query, "created_at": condition}
+
+
+async def migrate_created_at(db: AsyncDatabase, batch_size: int = CREATED_AT_MIGRATION_BATCH_SIZE, pause: float = CREATED_AT_MIGRATION_PAUSE_SECONDS) -> dict:
+    """
+    文字列の created_at を、batch_size件ずつ日時に変換する。
+    変換中に他の処理が created_at を書き換えた場合に上書きしないよう、元の文字列と一致する場合だけ更新する。
+    変換したアイテムがあった場合は、group_stats を作り直す（first_created / last_updated も日時になる）。
+    """
+    report = {"migrated": 0, "skipped": 0}
+    last_id = None
+    while True:
+        query = {"created_at": {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await db.images.find(query, {"created_at": 1}).sort("_id", 1).limit(batch_size).to_list()
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+
+        requests = []
+        for doc in batch:
+            converted = parse_legacy_created_at(doc["created_at"])
+            if converted is None:
+                logging.warning(f"created_at migration: cannot parse {doc['created_at']!r} of {doc['_id']}")
+                report["skipped"] += 1
+                continue
+            requests.append(UpdateOne({"_id": doc["_id"], "created_at": doc["created_at"]}, {"$set": {"created_at": converted}}))
+        if requests:
+            result = await db.images.bulk_write(requests, ordered=False)
+            report["migrated"] += result.modified_count
+        if pause:
+            await asyncio.sleep(pause)
+
+    if report["migrated"]:
+        await rebuild_group_stats(db)
+    return report
+
+
+async def run_created_at_migration():
+    """
+    アプリのlifespanからタスクとして起動される。変換するアイテムがなければすぐに終わる。
+    """
+    try:
+        if await mongo.db.images.find_one({"created_at": {"$type": "string"}}, {"_id": 1}) is None:
+            return
+        if not await acquire_lock(mongo.db, LOCK_ID, LOCK_SECONDS):
+            return
+        report = await migrate_created_at(mongo.db)
+        logging.info(f"created_at migration: migrated {report['migrated']} items, skipped {report['skipped']}")
+    except PyMongoError as e:
+        logging.error(f"created_at migration failed: {e}")
+
+
+async def main() -> int:
+    await mongo.connect()
+    try:
+        report = await migrate_created_at(mongo.db)
+        print(f"{report['migrated']} 件の created_at を日時に変換しました（変換できなかったもの: {report['skipped']} 件）。")
+        return 0
+    finally:
+        await mongo.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,209 @@
+# deletion_jobs.py
+# アイテム・グループの削除をバックグラウンドのジョブとして実行する処理。
+# 大きなグループの削除は数分かかることがあり、HTTPリクエストの中で実行するとプロキシでタイムアウトするため、
+# リクエストではジョブを登録してすぐに返し、削除はジョブを登録したワーカーのタスクとして実行する。
+#
+# ジョブの状態は deletion_jobs コレクションに保存するため、どのワーカーからでも進捗を確認できる
+# （GET /admin/api/deletion_jobs/{job_id}。統計ページはこれを定期的に取得して進捗を表示する）。
+#
+# 削除の手順（DELETION_BATCH_SIZE 件のアイテムごと）:
+#   1. images から、画像の_id（フルサイズ画像とサムネイル）だけを取得する
+#   2. images のドキュメントを削除する（一覧に表示されなくなる）
+#   3. fs.files / fs.chunks を $in でまとめて削除する（派生画像も含む）
+# 2と3の間でワーカーが停止した場合に残る画像は、孤立ファイルとして扱う。
+#
+# 環境変数で設定できる項目:
+#   DELETION_BATCH_SIZE    : 1回に削除するアイテム数（既定: 100）
+#   DELETION_PAUSE_SECONDS : バッチごとの待ち時間。他のリクエストへの影響を抑える（既定: 0.05）
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import PyMongoError
+
+from services.gridfs_cleanup import delete_gridfs_files, delete_gridfs_files_matching
+from services.group_stats import record_item_removed, delete_group_stats
+from services.thumbnail_cache import thumbnail_cache
+
+DELETION_BATCH_SIZE = int(os.environ.get("DELETION_BATCH_SIZE", "100"))
+DELETION_PAUSE_SECONDS = float(os.environ.get("DELETION_PAUSE_SECONDS", "0.05"))
+
+FILE_BATCH_SIZE = 200 # fs.files / fs.chunks を1回の $in で削除するファイル数
+STALE_JOB_SECONDS = 120 # この秒数の間進捗が更新されていない実行中のジョブは、停止したものとみなす
+
+# 画像の削除とグループの集計に必要なフィールドだけを取得する
+ITEM_PROJECTION = {"group_id": 1, "images": 1, "db_uploaded": 1, "meta_added": 1}
+
+# 実行中のタスク（ガベージコレクションで途中で破棄されないよう参照を保持する）
+_running_tasks: set[asyncio.Task] = set()
+
+
+async def resolve_item_file_ids(db: AsyncDatabase, items: list[dict]) -> list[ObjectId]:
+    """
+    アイテムの画像（フルサイズ画像とサムネイル）のGridFSの_idを返す。
+    _idを保存していない古いアイテムは、ファイル名からまとめて1回で_idを調べる。
+    """
+    file_ids, legacy_filenames = [], []
+    for item in items:
+        for image_info in item.get("images", []):
+            for id_field, name_field in (("file_id", "filename"), ("thumbnail_file_id", "thumbnail_filename")):
+                if ObjectId.is_valid(image_info.get(id_field) or ""):
+                    file_ids.append(ObjectId(image_info[id_field]))
+                elif image_info.get(name_field):
+                    legacy_filenames.append(image_info[name_field])
+    if legacy_filenames:
+        async for file in db.fs.files.find({"filename": {"$in": legacy_filenames}}, {"_id": 1}):
+            file_ids.append(file["_id"])
+    return file_ids
+
+
+async def delete_item_files(db: AsyncDatabase, items: list[dict]) -> tuple[int, int]:
+    """
+    アイテムの画像と、その派生画像をGridFSから削除し、キャッシュからも削除する。
+    削除したファイル数と、そのバイト数の合計（派生画像を除く）を返す。
+    """
+    file_ids = await resolve_item_file_ids(db, items)
+    if not file_ids:
+        return 0, 0
+
+    deleted_files, deleted_bytes = 0, 0
+    for i in range(0, len(file_ids), FILE_BATCH_SIZE):
+        batch = file_ids[i:i + FILE_BATCH_SIZE]
+        count, length = await delete_gridfs_files(db, batch)
+        deleted_files += count
+        deleted_bytes += length
+        derivative_count, _ = await delete_gridfs_files_matching(db, {"derivative_of": {"$in": batch}}, batch_size=FILE_BATCH_SIZE)
+        deleted_files += derivative_count
+    thumbnail_cache.invalidate(file_ids)
+    return deleted_files, deleted_bytes
+
+
+def job_status(job: dict) -> dict:
+    """
+    ジョブのドキュメントを、進捗確認APIで返す形式にする。
+    """
+    status = job["status"]
+    if status == "running" and job["updated_at"] < datetime.utcnow() - timedelta(seconds=STALE_JOB_SECONDS):
+        status = "interrupted"
+    return {
+        "job_id": str(job["_id"]),
+        "kind": job["kind"],
+        "group_id": job.get("group_id"),
+        "item_id": str(job["item_id"]) if job.get("item_id") else None,
+        "status": status,
+        "items_total": job.get("items_total", 0),
+        "items_deleted": job.get("items_deleted", 0),
+        "files_deleted": job.get("files_deleted", 0),
+        "bytes_deleted": job.get("bytes_deleted", 0),
+        "error": job.get("error"),
+    }
+
+
+async def create_job(db: AsyncDatabase, kind: str, group_id: str, items_total: int, item_id: ObjectId | None = None) -> ObjectId:
+    now = datetime.utcnow()
+    result = await db.deletion_jobs.insert_one({
+        "kind": kind,
+        "group_id": group_id,
+        "item_id": item_id,
+        "status": "running",
+        "items_total": items_total,
+        "items_deleted": 0,
+        "files_deleted": 0,
+        "bytes_deleted": 0,
+        "owner": os.getpid(),
+        "created_at": now,
+        "updated_at": now,
+    })
+    return result.inserted_id
+
+
+async def record_progress(db: AsyncDatabase, job_id: ObjectId, items: int, files: int, length: int):
+    await db.deletion_jobs.update_one(
+        {"_id": job_id},
+        {"$inc": {"items_deleted": items, "files_deleted": files, "bytes_deleted": length}, "$set": {"updated_at": datetime.utcnow()}},
+    )
+
+
+async def finish_job(db: AsyncDatabase, job_id: ObjectId, error: str | None = None):
+    now = datetime.utcnow()
+    update = {"status": "failed" if error else "done", "updated_at": now, "finished_at": now}
+    if error:
+        update["error"] = error
+    await db.deletion_jobs.update_one({"_id": job_id}, {"$set": update})
+
+
+def spawn(coroutine):
+    task = asyncio.create_task(coroutine)
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+
+
+async def run_item_job(db: AsyncDatabase, job_id: ObjectId, item: dict):
+    try:
+        files, length = await delete_item_files(db, [item])
+        await record_item_removed(db, item, length)
+        await record_progress(db, job_id, 0, files, length)
+        await finish_job(db, job_id)
+    except PyMongoError as e:
+        logging.error(f"Deletion job {job_id} failed: {e}")
+        await finish_job(db, job_id, error=str(e))
+
+
+async def run_group_job(db: AsyncDatabase, job_id: ObjectId, group_id: str):
+    try:
+        while True:
+            items = await db.images.find({"group_id": group_id}, ITEM_PROJECTION).limit(DELETION_BATCH_SIZE).to_list()
+            if not items:
+                break
+            result = await db.images.delete_many({"_id": {"$in": [item["_id"] for item in items]}})
+            files, length = await delete_item_files(db, items)
+            await record_progress(db, job_id, result.deleted_count, files, length)
+            if DELETION_PAUSE_SECONDS:
+                await asyncio.sleep(DELETION_PAUSE_SECONDS)
+        await delete_group_stats(db, group_id)
+        await finish_job(db, job_id)
+    except PyMongoError as e:
+        logging.error(f"Deletion job {job_id} failed: {e}")
+        await finish_job(db, job_id, error=str(e))
+
+
+async def find_active_group_job(db: AsyncDatabase, group_id: str) -> dict | None:
+    """
+    同じグループを削除中のジョブがあれば返す（停止したとみなされるものは除く）。
+    """
+    return await db.deletion_jobs.find_one({
+        "kind": "group",
+        "group_id": group_id,
+        "status": "running",
+        "updated_at": {"$gte": datetime.utcnow() - timedelta(seconds=STALE_JOB_SECONDS)},
+    })
+
+
+async def start_group_deletion(db: AsyncDatabase, group_id: str) -> ObjectId:
+    """
+    グループの削除ジョブを登録して開始し、ジョブの_idを返す。同じグループを削除中の場合はそのジョブの_idを返す。
+    """
+    if (job := await find_active_group_job(db, group_id)) is not None:
+        return job["_id"]
+    items_total = await db.images.count_documents({"group_id": group_id})
+    job_id = await create_job(db, "group", group_id, items_total)
+    spawn(run_group_job(db, job_id, group_id))
+    return job_id
+
+
+async def start_item_deletion(db: AsyncDatabase, item_id: ObjectId) -> ObjectId | None:
+    """
+    アイテムを削除し、画像の削除ジョブを開始してジョブの_idを返す。アイテムが見つからない場合はNone。
+    アイテムのドキュメントはすぐに削除するため、リダイレクト後の一覧には表示されない。
+    """
+    item = await db.images.find_one_and_delete({"_id": item_id}, projection=ITEM_PROJECTION)
+    if item is None:
+        return None
+    job_id = await create_job(db, "item", item["group_id"], 1, item_id=item_id)
+    await record_progress(db, job_id, 1, 0, 0)
+    spawn(run_item_job(db, job_id, item))
+    return job_id
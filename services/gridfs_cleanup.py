@@ -0,0 +1,56 @@
+# gridfs_cleanup.py
+# GridFSのファイルをまとめて削除するための処理。
+# fs.delete() はファイルごとに fs.files と fs.chunks を1回ずつ削除するため、大量のファイルを消すと往復回数が増える。
+# ここでは fs.files / fs.chunks を $in でまとめて削除する。
+
+import asyncio
+
+from pymongo.asynchronous.database import AsyncDatabase
+
+
+async def delete_gridfs_files(db: AsyncDatabase, file_ids: list, extra_filter: dict | None = None) -> tuple[int, int]:
+    """
+    指定された_idのGridFSファイルを、fs.files → fs.chunks の順にまとめて削除する。
+    extra_filterを指定した場合は、その条件に一致するファイルだけを削除する
+    （検索してから削除するまでの間に、条件から外れたファイルを消さないため）。
+    削除したファイル数と、そのバイト数の合計を返す。
+    """
+    if not file_ids:
+        return 0, 0
+
+    query = {"_id": {"$in": file_ids}, **(extra_filter or {})}
+    targets = await db.fs.files.find(query, {"_id": 1, "length": 1}).to_list()
+    if not targets:
+        return 0, 0
+
+    target_ids = [file["_id"] for file in targets]
+    await db.fs.files.delete_many({"_id": {"$in": target_ids}, **(extra_filter or {})})
+
+    # 削除の直前に条件から外れたファイル（まだ fs.files に残っているもの）のチャンクは残す
+    remaining = set(await db.fs.files.distinct("_id", {"_id": {"$in": target_ids}}))
+    deleted = [file for file in targets if file["_id"] not in remaining]
+    if deleted:
+        await db.fs.chunks.delete_many({"files_id": {"$in": [file["_id"] for file in deleted]}})
+
+    return len(deleted), sum(file.get("length", 0) for file in deleted)
+
+
+async def delete_gridfs_files_matching(db: AsyncDatabase, query: dict, batch_size: int = 200, pause: float = 0) -> tuple[int, int]:
+    """
+    queryに一致するGridFSファイルを、batch_size件ずつまとめて削除する。
+    pauseを指定した場合は、バッチごとにその秒数だけ待つ（他のリクエストへの影響を抑えるため）。
+    削除したファイル数と、そのバイト数の合計を返す。
+    """
+    files, reclaimed_bytes = 0, 0
+    while True:
+        batch = await db.fs.files.find(query, {"_id": 1}).limit(batch_size).to_list()
+        if not batch:
+            break
+        deleted, deleted_bytes = await delete_gridfs_files(db, [file["_id"] for file in batch], extra_filter=query)
+        files += deleted
+        reclaimed_bytes += deleted_bytes
+        if len(batch) < batch_size or deleted == 0:
+            break
+        if pause:
+            await asyncio.sleep(pause)
+    return files, reclaimed_bytes
@@ -0,0 +1,196 @@
+# gridfs_reconcile.py
+# GridFSの孤立ファイルを検出し、必要に応じて削除するコマンド。
+# 孤立ファイルはストレージとインデックスの容量を使い、作業領域（RAMに載せたいデータ）を圧迫する。
+#
+#   python -m services.gridfs_reconcile                     # 検出して報告するだけ（削除しない）
+#   python -m services.gridfs_reconcile --delete            # 孤立ファイルを削除する
+#   python -m services.gridfs_reconcile --delete --compact  # 削除後に compact を実行し、ディスクの空き領域を返却する
+#
+# 検出するもの:
+#   1. どの images ドキュメントからも参照されていない fs.files（本登録済みのもの）
+#      images が参照する _id / ファイル名を一時コレクション（reconcile_refs）にまとめ、
+#      fs.files 側から $lookup で照合する（照合はサーバー側で行い、アプリには孤立ファイルだけが返る）。
+#      派生画像は、元画像の _id（derivative_of）が参照されていなければ孤立ファイルとする。
+#   2. fs.files が存在しない fs.chunks
+#      fs.chunks（files_id順）と fs.files（_id順）をインデックス順に読みながら突き合わせる（ソート済みのマージ）。
+# どちらも、すべての_idをPythonのsetに載せることはしないため、メモリ使用量はデータ量によらず一定。
+#
+# 一時画像（temporary=True）は services/temp_sweeper.py で削除するため対象外。
+# アップロード中・本登録中のファイルを誤って削除しないよう、--min-age-hours（既定: 48時間）より新しいものは対象外とする。
+
+import argparse
+import asyncio
+import sys
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo.asynchronous.database import AsyncDatabase
+
+from db import mongo
+from services.gridfs_cleanup import delete_gridfs_files
+
+REFS_COLLECTION = "reconcile_refs"
+BATCH_SIZE = 500
+
+
+async def build_reference_collection(db: AsyncDatabase):
+    """
+    images が参照する画像の _id（文字列）とファイル名を、一時コレクションに重複なく書き出す。
+    """
+    pipeline = [
+        {"$unwind": "$images"},
+        {"$project": {"_id": 0, "refs": [
+            "$images.file_id", "$images.thumbnail_file_id", "$images.filename", "$images.thumbnail_filename",
+        ]}},
+        {"$unwind": "$refs"},
+        {"$match": {"refs": {"$type": "string"}}},
+        {"$group": {"_id": "$refs"}},
+        {"$out": REFS_COLLECTION},
+    ]
+    await (await db.images.aggregate(pipeline, allowDiskUse=True)).to_list()
+
+
+async def iter_orphan_files(db: AsyncDatabase, cutoff: datetime):
+    """
+    どの images ドキュメントからも参照されていない fs.files を、_id と length だけにして順に返す。
+    """
+    pipeline = [
+        {"$match": {"temporary": {"$ne": True}, "uploadDate": {"$lt": cutoff}}},
+        {"$project": {
+            "length": 1,
+            "filename": 1,
+            # 派生画像は元画像の_idで照合する
+            "ref_key": {"$toString": {"$ifNull": ["$derivative_of", "$_id"]}},
+        }},
+        {"$lookup": {"from": REFS_COLLECTION, "localField": "ref_key", "foreignField": "_id", "as": "by_id"}},
+        {"$match": {"by_id": {"$size": 0}}},
+        {"$lookup": {"from": REFS_COLLECTION, "localField": "filename", "foreignField": "_id", "as": "by_filename"}},
+        {"$match": {"by_filename": {"$size": 0}}},
+        {"$project": {"length": 1}},
+    ]
+    async for file in await db.fs.files.aggregate(pipeline, allowDiskUse=True):
+        yield file
+
+
+async def iter_orphan_chunk_file_ids(db: AsyncDatabase, cutoff: datetime):
+    """
+    fs.files が存在しない fs.chunks の files_id を順に返す。
+    fs.chunks の (files_id, n) インデックスと fs.files の _id インデックスを同じ順に読み、突き合わせる。
+    GridFSはチャンクを書き込んでから fs.files を作成するため、cutoffより新しいチャンクは対象外とする。
+    """
+    files = db.fs.files.find({}, {"_id": 1}).sort("_id", 1)
+    current = await anext(files, None)
+    previous = None
+    chunks = db.fs.chunks.find({}, {"_id": 0, "files_id": 1}).sort([("files_id", 1), ("n", 1)])
+    async for chunk in chunks:
+        files_id = chunk["files_id"]
+        if files_id == previous or not isinstance(files_id, ObjectId):
+            continue
+        previous = files_id
+        while current is not None and current["_id"] < files_id:
+            current = await anext(files, None)
+        if current is not None and current["_id"] == files_id:
+            continue
+        if files_id.generation_time.replace(tzinfo=None) < cutoff:
+            yield files_id
+
+
+async def chunk_bytes(db: AsyncDatabase, files_ids: list) -> int:
+    pipeline = [
+        {"$match": {"files_id": {"$in": files_ids}}},
+        {"$group": {"_id": None, "bytes": {"$sum": {"$binarySize": "$data"}}}},
+    ]
+    result = await (await db.fs.chunks.aggregate(pipeline)).to_list()
+    return result[0]["bytes"] if result else 0
+
+
+async def delete_orphan_chunks(db: AsyncDatabase, files_ids: list) -> int:
+    """
+    fs.files が存在しないことを確認し直してから、チャンクを削除する。削除したチャンク数を返す。
+    """
+    existing = set(await db.fs.files.distinct("_id", {"_id": {"$in": files_ids}}))
+    targets = [files_id for files_id in files_ids if files_id not in existing]
+    if not targets:
+        return 0
+    result = await db.fs.chunks.delete_many({"files_id": {"$in": targets}})
+    return result.deleted_count
+
+
+async def reconcile(db: AsyncDatabase, min_age_hours: float = 48, delete: bool = False) -> dict:
+    """
+    孤立ファイルを検出し、deleteがTrueの場合は削除する。件数とバイト数を返す。
+    """
+    cutoff = datetime.utcnow() - timedelta(hours=min_age_hours)
+    report = {"orphan_files": 0, "orphan_file_bytes": 0, "orphan_chunk_files": 0, "orphan_chunk_bytes": 0, "deleted_files": 0, "deleted_chunks": 0}
+
+    await build_reference_collection(db)
+    try:
+        batch = []
+        async for file in iter_orphan_files(db, cutoff):
+            report["orphan_files"] += 1
+            report["orphan_file_bytes"] += file.get("length", 0)
+            batch.append(file["_id"])
+            if len(batch) >= BATCH_SIZE:
+                if delete:
+                    report["deleted_files"] += (await delete_gridfs_files(db, batch, extra_filter={"temporary": {"$ne": True}}))[0]
+                batch = []
+        if batch and delete:
+            report["deleted_files"] += (await delete_gridfs_files(db, batch, extra_filter={"temporary": {"$ne": True}}))[0]
+    finally:
+        await db.drop_collection(REFS_COLLECTION)
+
+    # fs.files を削除した後に突き合わせる（上で削除したファイルのチャンクは、delete_gridfs_files で削除済み）
+    batch = []
+    async for files_id in iter_orphan_chunk_file_ids(db, cutoff):
+        batch.append(files_id)
+        if len(batch) >= BATCH_SIZE:
+            await reconcile_chunk_batch(db, batch, report, delete)
+            batch = []
+    if batch:
+        await reconcile_chunk_batch(db, batch, report, delete)
+    return report
+
+
+async def reconcile_chunk_batch(db: AsyncDatabase, files_ids: list, report: dict, delete: bool):
+    report["orphan_chunk_files"] += len(files_ids)
+    report["orphan_chunk_bytes"] += await chunk_bytes(db, files_ids)
+    if delete:
+        report["deleted_chunks"] += await delete_orphan_chunks(db, files_ids)
+
+
+async def compact(db: AsyncDatabase) -> int:
+    """
+    fs.files / fs.chunks に compact を実行し、OSに返却したバイト数の合計を返す。
+    ※ 実行中は対象のコレクションへの一部の操作が待たされるため、利用の少ない時間帯に実行すること。
+    """
+    freed = 0
+    for collection in ("fs.chunks", "fs.files"):
+        result = await db.command("compact", collection)
+        freed += result.get("bytesFreed", 0)
+    return freed
+
+
+async def main(args) -> int:
+    await mongo.connect()
+    try:
+        report = await reconcile(mongo.db, args.min_age_hours, args.delete)
+        print(f"参照されていないファイル: {report['orphan_files']} 件（{report['orphan_file_bytes']} バイト）")
+        print(f"fs.files のないチャンク: {report['orphan_chunk_files']} ファイル分（{report['orphan_chunk_bytes']} バイト）")
+        reclaimable = report["orphan_file_bytes"] + report["orphan_chunk_bytes"]
+        if args.delete:
+            print(f"{report['deleted_files']} 件のファイルと {report['deleted_chunks']} 個のチャンクを削除しました（{reclaimable} バイト）。")
+        else:
+            print(f"削除できる容量: {reclaimable} バイト（削除するには --delete を指定してください）")
+        if args.compact:
+            print(f"compact により {await compact(mongo.db)} バイトをOSに返却しました。")
+        return 0
+    finally:
+        await mongo.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GridFSの孤立ファイルを検出・削除する")
+    parser.add_argument("--delete", action="store_true", help="孤立ファイルを削除する")
+    parser.add_argument("--compact", action="store_true", help="削除後に fs.files / fs.chunks の compact を実行する")
+    parser.add_argument("--min-age-hours", type=float, default=48, help="この時間より新しいファイルは対象外にする（既定: 48）")
+    sys.exit(asyncio.run(main(parser.parse_args())))
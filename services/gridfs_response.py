@@ -0,0 +1,146 @@
+# gridfs_response.py
+# GridFSに保存された画像を、メモリに全体を載せずにチャンク単位で返すための処理。
+# Range（部分取得）とHEADに対応し、ETag / Last-Modified / Cache-Control を付けて返す。
+# If-None-Match / If-Modified-Since が一致する場合は、チャンクを読まずに304を返す。
+
+import re
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+import gridfs
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from pymongo.asynchronous.database import AsyncDatabase
+
+# ファイルの内容が変わらないURL（GridFSの_idを含むURLなど）に付けるCache-Control
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# 毎回ETagで確認させる場合のCache-Control（内容が同じなら304が返るため、再ダウンロードは発生しない）
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def file_etag(file_doc: dict) -> str:
+    """
+    fs.filesのドキュメントからETagを作る。md5が保存されていればmd5、なければ_idとサイズを使う。
+    """
+    if file_doc.get("md5"):
+        return f'"{file_doc["md5"]}"'
+    return f'"{file_doc["_id"]}-{file_doc["length"]}"'
+
+
+def parse_range(header: str | None, length: int) -> tuple[int, int] | None:
+    """
+    Rangeヘッダーを (開始位置, 終了位置) に変換する。終了位置はその位置のバイトを含む。
+    Rangeヘッダーがない場合、または解釈できない形式（複数範囲など）の場合はNoneを返す（全体を返す）。
+    範囲がファイルの外にある場合は ValueError を発生させる。
+    """
+    if not header:
+        return None
+    match = RANGE_PATTERN.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    start, end = match.group(1), match.group(2)
+    if start == "":
+        # bytes=-500 : 末尾の500バイト
+        suffix = int(end)
+        if suffix == 0:
+            raise ValueError("unsatisfiable range")
+        return max(length - suffix, 0), length - 1
+
+    start = int(start)
+    end = int(end) if end else length - 1
+    if start >= length or end < start:
+        raise ValueError("unsatisfiable range")
+    return start, min(end, length - 1)
+
+
+def is_not_modified(request: Request, etag: str, last_modified) -> bool:
+    """
+    条件付きリクエスト（If-None-Match / If-Modified-Since）に対して、304を返してよいかを判定する。
+    If-None-Match がある場合はそちらを優先する。
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+async def iter_gridfs_range(grid_out: gridfs.AsyncGridOut, start: int, end: int):
+    """
+    GridFSのファイルのstartからendまで（endを含む）を、チャンク単位で順に返す。
+    """
+    try:
+        await grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        await grid_out.close()
+
+
+async def gridfs_file_response(
+    request: Request,
+    db: AsyncDatabase,
+    file_doc: dict,
+    media_type: str = "image/jpeg",
+    cache_control: str = REVALIDATE_CACHE_CONTROL,
+) -> Response:
+    """
+    fs.filesのドキュメントで指定されたファイルを返すレスポンスを作る。
+    GET / HEAD、Range、条件付きリクエストに対応する。
+    """
+    length = file_doc["length"]
+    etag = file_etag(file_doc)
+    last_modified = file_doc.get("uploadDate")
+    if last_modified is not None and last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    # If-Range が現在のETagと一致しない場合は、Rangeを無視して全体を返す
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range.strip() != etag:
+        range_header = None
+
+    try:
+        byte_range = parse_range(range_header, length)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{length}"})
+
+    status_code = 200
+    start, end = 0, length - 1
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    headers["Content-Length"] = str(end - start + 1 if length else 0)
+
+    if request.method == "HEAD" or length == 0:
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+
+    grid_out = gridfs.AsyncGridOut(db.fs, file_document=file_doc)
+    return StreamingResponse(iter_gridfs_range(grid_out, start, end), status_code=status_code, headers=headers, media_type=media_type)
@@ -0,0 +1,167 @@
+# group_stats.py
+# グループごとの集計を group_stats コレクションに保持する（_id は group_id）。
+# アイテムの本登録・削除、アップロード済みへの更新、メタデータの更新のたびに差分で更新するため、
+# グループ一覧（/admin/api/groups）と統計ページ（/admin/statistics）は images 全体を集計せずに表示できる。
+#
+# 保持する項目:
+#   item_count / uploaded_count / not_uploaded_count / meta_added_count : アイテム数
+#   first_created / last_updated : アイテムの created_at の最小値 / 最大値
+#   total_bytes : 本登録済みの画像（フルサイズ画像とサムネイル）の合計バイト数
+#
+# 集計がずれた場合（差分更新の途中での障害など）は、以下のコマンドで images と fs.files から作り直す:
+#   python -m services.group_stats rebuild
+
+import asyncio
+import logging
+import sys
+
+from pymongo import ReplaceOne
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import PyMongoError
+
+from db import mongo
+from services.temp_sweeper import acquire_lock
+
+LOCK_ID = "group_stats_rebuild"
+LOCK_SECONDS = 600
+
+
+def uploaded_field(item: dict) -> str | None:
+    """
+    アイテムが数えられる件数の項目名（db_uploadedがTrue/Falseでない場合はどちらにも数えない）。
+    """
+    if item.get("db_uploaded") is True:
+        return "uploaded_count"
+    if item.get("db_uploaded") is False:
+        return "not_uploaded_count"
+    return None
+
+
+async def record_item_added(db: AsyncDatabase, item: dict, file_bytes: int, session=None):
+    """
+    アイテムが本登録されたときに呼ぶ。file_bytesは本登録した画像の合計バイト数。
+    """
+    increments = {"item_count": 1, "total_bytes": file_bytes, "meta_added_count": 1 if item.get("meta_added") else 0}
+    if field := uploaded_field(item):
+        increments[field] = 1
+    await db.group_stats.update_one(
+        {"_id": item["group_id"]},
+        {
+            "$inc": increments,
+            "$min": {"first_created": item.get("created_at")},
+            "$max": {"last_updated": item.get("created_at")},
+        },
+        upsert=True,
+        session=session,
+    )
+
+
+async def record_item_removed(db: AsyncDatabase, item: dict, file_bytes: int):
+    """
+    アイテムが削除されたときに呼ぶ。file_bytesは削除した画像の合計バイト数。
+    """
+    increments = {"item_count": -1, "total_bytes": -file_bytes, "meta_added_count": -1 if item.get("meta_added") else 0}
+    if field := uploaded_field(item):
+        increments[field] = -1
+    await db.group_stats.update_one({"_id": item["group_id"]}, {"$inc": increments})
+    await refresh_created_range(db, item["group_id"])
+
+
+async def refresh_created_range(db: AsyncDatabase, group_id: str):
+    """
+    グループの first_created / last_updated を、インデックス（group_id, created_at）を使って取り直す。
+    アイテムが残っていない場合は集計を削除する。
+    """
+    first = await db.images.find_one({"group_id": group_id}, {"created_at": 1}, sort=[("created_at", 1)])
+    if first is None:
+        await db.group_stats.delete_one({"_id": group_id})
+        return
+    last = await db.images.find_one({"group_id": group_id}, {"created_at": 1}, sort=[("created_at", -1)])
+    await db.group_stats.update_one(
+        {"_id": group_id},
+        {"$set": {"first_created": first.get("created_at"), "last_updated": last.get("created_at")}},
+    )
+
+
+async def record_uploaded(db: AsyncDatabase, group_id: str, count: int = 1):
+    """
+    count件のアイテムが未アップロードからアップロード済みになったときに呼ぶ。
+    """
+    await db.group_stats.update_one({"_id": group_id}, {"$inc": {"uploaded_count": count, "not_uploaded_count": -count}})
+
+
+async def record_meta_added(db: AsyncDatabase, group_id: str, count: int):
+    """
+    meta_addedが変わったアイテムの件数を反映する（Trueになった場合は正、Falseになった場合は負）。
+    """
+    await db.group_stats.update_one({"_id": group_id}, {"$inc": {"meta_added_count": count}})
+
+
+async def delete_group_stats(db: AsyncDatabase, group_id: str):
+    await db.group_stats.delete_one({"_id": group_id})
+
+
+async def rebuild_group_stats(db: AsyncDatabase) -> int:
+    """
+    images と fs.files を集計し、group_stats を作り直す。集計したグループ数を返す。
+    メモリに載るのはグループごとの集計結果だけ。
+    ※ 集計してから書き込むまでの間に record_* で反映された差分は上書きされるため、書き込みの少ない時間帯に実行すること。
+    """
+    pipeline = [
+        {"$group": {
+            "_id": "$group_id",
+            "item_count": {"$sum": 1},
+            "uploaded_count": {"$sum": {"$cond": [{"$eq": ["$db_uploaded", True]}, 1, 0]}},
+            "not_uploaded_count": {"$sum": {"$cond": [{"$eq": ["$db_uploaded", False]}, 1, 0]}},
+            "meta_added_count": {"$sum": {"$cond": [{"$eq": ["$meta_added", True]}, 1, 0]}},
+            "first_created": {"$min": "$created_at"},
+            "last_updated": {"$max": "$created_at"},
+        }},
+    ]
+    stats = {doc["_id"]: {**doc, "total_bytes": 0} async for doc in await db.images.aggregate(pipeline)}
+
+    # 画像のバイト数は fs.files の group_id で集計する（本登録済みのもののみ）
+    bytes_pipeline = [
+        {"$match": {"temporary": False, "group_id": {"$exists": True}}},
+        {"$group": {"_id": "$group_id", "total_bytes": {"$sum": "$length"}}},
+    ]
+    async for doc in await db.fs.files.aggregate(bytes_pipeline):
+        if doc["_id"] in stats:
+            stats[doc["_id"]]["total_bytes"] = doc["total_bytes"]
+
+    if stats:
+        await db.group_stats.bulk_write([ReplaceOne({"_id": group_id}, doc, upsert=True) for group_id, doc in stats.items()], ordered=False)
+    await db.group_stats.delete_many({"_id": {"$nin": list(stats)}})
+    return len(stats)
+
+
+async def ensure_group_stats(db: AsyncDatabase):
+    """
+    group_stats が空で images にアイテムがある場合（初回の起動時）に、集計を作成する。
+    複数のgunicornワーカーが同時に作成しないよう、job_locksコレクションのロックを取得したワーカーだけが実行する。
+    """
+    try:
+        if await db.group_stats.find_one({}, {"_id": 1}) is None and await db.images.find_one({}, {"_id": 1}) is not None:
+            if not await acquire_lock(db, LOCK_ID, LOCK_SECONDS):
+                return
+            count = await rebuild_group_stats(db)
+            logging.info(f"Built group_stats for {count} groups")
+    except PyMongoError as e:
+        logging.error(f"Failed to build group_stats: {e}")
+
+
+async def main(command: str) -> int:
+    await mongo.connect()
+    try:
+        count = await rebuild_group_stats(mongo.db)
+        print(f"{count} グループの集計を作り直しました。")
+        return 0
+    finally:
+        await mongo.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] != "rebuild":
+        print("使用法: python -m services.group_stats rebuild")
+        sys.exit(1)
+    sys.exit(asyncio.run(main(sys.argv[1])))
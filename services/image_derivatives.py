@@ -0,0 +1,100 @@
+# image_derivatives.py
+# 管理画面で表示する大きさに縮小した画像（派生画像）を、必要になった時点で一度だけ生成してGridFSに保存する処理。
+# 派生画像は fs.files の derivative_of（元画像の_id）、width、format で検索する。
+# 生成した派生画像はサムネイルと同じキャッシュ（services/thumbnail_cache.py）から返す。
+#
+# 同じワーカー内の同時生成はロックで防ぐ。別のワーカーが同時に生成した場合は、fs.files の一意インデックス
+# （derivative_of, width, format。indexes.py）で後から保存した方が失敗するため、その画像を削除して先に保存された方を返す。
+
+import asyncio
+from datetime import datetime
+
+import gridfs
+from bson import ObjectId
+from gridfs.errors import FileExists
+from pymongo.asynchronous.database import AsyncDatabase
+
+from services.image_processing import build_derivative
+from services.process_pool import run_in_pool
+from services.upload_ingest import new_spool_path, remove_spool_file
+
+# 生成を許可する幅（任意の幅を受け付けると、派生画像が際限なく増えるため）
+DERIVATIVE_WIDTHS = (240, 480, 960)
+# format → (Pillowの形式名, Content-Type)
+DERIVATIVE_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+# 同じ派生画像を同時に生成しないためのロック（ワーカーごと）。キー → [ロック, ロックを使用中・待機中のリクエスト数]
+# ロックは使用中・待機中のリクエストがいなくなった時点で削除する
+_locks: dict[str, list] = {}
+
+
+def derivative_key(source_id, width: int, image_format: str) -> str:
+    """
+    派生画像のキー。GridFSのファイル名とキャッシュのキーに使う。
+    """
+    return f"{source_id}_w{width}.{image_format}"
+
+
+async def find_derivative(db: AsyncDatabase, source_id, width: int, image_format: str) -> dict | None:
+    return await db.fs.files.find_one({"derivative_of": source_id, "width": width, "format": image_format})
+
+
+async def get_or_create_derivative(db: AsyncDatabase, fs: gridfs.AsyncGridFS, source_doc: dict, width: int, image_format: str) -> dict:
+    """
+    元画像（fs.filesのドキュメント）の派生画像を返す。まだなければ生成してGridFSに保存する。
+    画像の縮小はプロセスプールで実行する。プールが満杯の場合は PoolSaturatedError を発生させる。
+    """
+    source_id = source_doc["_id"]
+    if (derivative := await find_derivative(db, source_id, width, image_format)) is not None:
+        return derivative
+
+    key = derivative_key(source_id, width, image_format)
+    entry = _locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            if (derivative := await find_derivative(db, source_id, width, image_format)) is not None:
+                return derivative
+
+            # 元画像はメモリに載せず、チャンク単位で一時ファイルに書き出してからプロセスプールに渡す
+            source_path = new_spool_path()
+            try:
+                grid_out = gridfs.AsyncGridOut(db.fs, file_document=source_doc)
+                try:
+                    with open(source_path, "wb") as f:
+                        while chunk := await grid_out.readchunk():
+                            f.write(chunk)
+                finally:
+                    await grid_out.close()
+                pil_format, content_type = DERIVATIVE_FORMATS[image_format]
+                data = await run_in_pool(build_derivative, source_path, width, pil_format)
+            finally:
+                remove_spool_file(source_path)
+
+            # fs.files の作成が一意インデックスで失敗した場合に、書き込み済みのチャンクを削除できるよう_idを決めておく
+            file_id = ObjectId()
+            try:
+                await fs.put(
+                    data,
+                    _id=file_id,
+                    filename=key,
+                    contentType=content_type,
+                    derivative_of=source_id,
+                    width=width,
+                    format=image_format,
+                    uploadDate=datetime.utcnow(),
+                )
+            except FileExists:
+                # 別のワーカーが先に同じ派生画像を保存した
+                await db.fs.chunks.delete_many({"files_id": file_id})
+                if (derivative := await find_derivative(db, source_id, width, image_format)) is not None:
+                    return derivative
+                raise
+            return await db.fs.files.find_one({"_id": file_id})
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _locks[key]
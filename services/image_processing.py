@@ -20,18 +20,36 @@ import cv2
 import numpy as np
 import imghdr
 import logging
+import os
+import shutil
 import threading
-from PIL import Image, ImageOps # ExifTagsを削除
+from PIL import Image, ImageDraw, ImageOps, ExifTags
 import io
 
+from services.dummy_image import replace_white_with_color
+
 logging.basicConfig(level=logging.INFO)
 lock = threading.Lock()
 MAX_IMAGE_SIZE = 5 * 1024 * 1024
 max_dim = 1080
+MAX_PASSTHROUGH_DIMENSION = 4096 # 再エンコードせずにそのまま保存するJPEGの最大辺
+# 再エンコードせずに保存するJPEGから取り除くマーカー（APP1: EXIF/XMP（位置情報を含む）、APP13: IPTC、COM: コメント）
+# APP0（JFIF）、APP2（ICCプロファイル）、APP14（Adobe。色空間の解釈に必要）は残す
+STRIPPED_JPEG_MARKERS = {0xE1, 0xED, 0xFE}
 
 # QRコード検出器の初期化
+# プロセスプールのワーカーでは init_worker() でプロセスごとに作り直す
 qr_detector = cv2.QRCodeDetector()
 
+def init_worker():
+    """
+    プロセスプールのワーカー起動時に呼ばれる初期化関数。
+    cv2.QRCodeDetector はプロセス間で共有できないため、ワーカープロセスごとに生成する。
+    """
+    global qr_detector
+    qr_detector = cv2.QRCodeDetector()
+    cv2.setNumThreads(1) # ワーカー数でスケールさせるため、OpenCV内部のスレッドは使わない
+
 def find_corner_point(points, corner="right"):
     """
     指定された頂点（右上または左上）を見つける関数。
@@ -71,11 +89,28 @@ def validate_image_file(image_data: bytes):
         return False, "Invalid image format or corrupted file."
     return True, None
 
-def load_and_orient_image_pil(image_data: bytes) -> Image.Image:
+def open_image_source(image_data: bytes | str) -> Image.Image:
+    """
+    画像のバイナリ、またはファイルパスからPIL Imageを開く（ピクセルのデコードはまだ行わない）。
+    """
+    if isinstance(image_data, bytes):
+        return Image.open(io.BytesIO(image_data))
+    return Image.open(image_data)
+
+def image_source_size(image_data: bytes | str) -> int:
+    """
+    画像のバイナリ、またはファイルパスのバイト数を返す。
+    """
+    if isinstance(image_data, bytes):
+        return len(image_data)
+    return os.path.getsize(image_data)
+
+def load_and_orient_image_pil(image_data: bytes | str) -> Image.Image:
     """
     Pillowで画像を読み込み、EXIFのOrientationタグに基づいて自動回転させたPIL Imageオブジェクトを返す。
+    image_dataには画像のバイナリ、またはファイルパスを指定できる。
     """
-    img_pil = Image.open(io.BytesIO(image_data))
+    img_pil = open_image_source(image_data)
     logging.info(f"Image opened. Original size: {img_pil.size}")
 
     # EXIF情報を取得
@@ -144,41 +179,170 @@ def generate_thumbnail(pil_image: Image.Image, max_size: int = 600) -> tuple[Ima
     was_scaled_down = (original_size != thumbnail_image.size)
     return thumbnail_image, was_scaled_down
 
-def process_image(image_data: bytes, x_offset: int, y_offset: int, mode: str, ip: str) -> tuple[bytes, str | None]:
+def to_rgb(pil_image: Image.Image) -> Image.Image:
     """
-    QRコードを検出し、画像をトリミングして返す。
+    JPEG保存用にPIL ImageをRGBモードへ変換する。
+    RGBAの場合は透明部分を白で埋める。
+    """
+    if pil_image.mode == 'RGBA':
+        background = Image.new('RGB', pil_image.size, (255, 255, 255)) # 白背景を作成
+        background.paste(pil_image, mask=pil_image.split()[3]) # アルファチャンネルをマスクとして使用
+        return background
+    if pil_image.mode != 'RGB':
+        return pil_image.convert('RGB')
+    return pil_image
+
+class ImagePipeline:
+    """
+    画像を一度だけデコード・EXIF回転し、同じピクセルバッファからすべてのレンディション
+    （トリミング済みフルサイズ画像、サムネイル、その他のサイズ）を生成するためのクラス。
+    途中でJPEGへのエンコード・デコードを挟まないため、処理時間と画質劣化を抑えられる。
+    """
+
+    def __init__(self, pil_image: Image.Image):
+        self.image = to_rgb(pil_image)
+
+    @classmethod
+    def from_bytes(cls, image_data: bytes | str) -> "ImagePipeline":
+        """
+        画像のバイナリ（またはファイルパス）をデコードし、EXIF回転を適用したパイプラインを生成する。
+        """
+        return cls(load_and_orient_image_pil(image_data))
+
+    def crop_square(self, box: tuple[int, int, int, int]):
+        """
+        指定範囲をトリミングし、白で余白を埋めて正方形にする（make_squareのPillow版）。
+        """
+        cropped = self.image.crop(box)
+        width, height = cropped.size
+        square_side = max(width, height)
+        squared = Image.new('RGB', (square_side, square_side), (255, 255, 255))
+        squared.paste(cropped, ((square_side - width) // 2, (square_side - height) // 2))
+        self.image = squared
+
+    def outline(self, box: tuple[int, int, int, int]):
+        """
+        トリミング範囲を緑の枠で描画する（確認用）。
+        """
+        ImageDraw.Draw(self.image).rectangle(box, outline=(0, 255, 0), width=10)
+
+    def fit(self, max_dimension: int):
+        """
+        画像の最大辺が指定された長さを超える場合、アスペクト比を維持して縮小する。
+        """
+        if max(self.image.size) > max_dimension:
+            self.image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+    def fit_width(self, width: int):
+        """
+        画像の幅が指定された長さを超える場合、アスペクト比を維持して幅をwidthに縮小する。
+        """
+        if self.image.width > width:
+            height = max(1, round(self.image.height * width / self.image.width))
+            self.image = self.image.resize((width, height), Image.Resampling.LANCZOS)
+
+    def save(self, fp, max_size: int | None = None, quality: int = 90, image_format: str = "JPEG") -> bool:
+        """
+        現在の画像をJPEG（image_formatで変更可）としてfp（ファイルパスまたはファイルオブジェクト）に書き出す。
+        max_sizeを指定した場合はその大きさに収まるように縮小する（元の画像は変更しない）。
+        縮小が行われたかどうかを返す。
+        """
+        image, was_scaled_down = self.image, False
+        if max_size is not None:
+            image, was_scaled_down = generate_thumbnail(self.image, max_size=max_size)
+        image.save(fp, format=image_format, quality=quality)
+        return was_scaled_down
+
+    def render(self, max_size: int | None = None, quality: int = 90, image_format: str = "JPEG") -> tuple[bytes, bool]:
+        """
+        現在の画像からJPEG（image_formatで変更可）のレンディションを生成する。
+        画像のバイナリと、縮小が行われたかどうかを返す。
+        """
+        buffer = io.BytesIO()
+        was_scaled_down = self.save(buffer, max_size=max_size, quality=quality, image_format=image_format)
+        return buffer.getvalue(), was_scaled_down
+
+def open_passthrough_jpeg(image_data: bytes | str) -> Image.Image | None:
+    """
+    アップロードされた画像が、再エンコードせずにそのまま保存できるJPEGかどうかを判定する。
+    条件: JPEG（ベースライン/プログレッシブ）、サイズと辺の長さが上限以内、RGBまたはグレースケール、
+    EXIFによる回転が不要であること。
+    条件を満たす場合は、まだピクセルをデコードしていないPIL Imageを返す。満たさない場合はNoneを返す。
+    """
+    if image_source_size(image_data) > MAX_IMAGE_SIZE:
+        return None
+    try:
+        img_pil = open_image_source(image_data)
+    except Exception:
+        return None
+    if img_pil.format != "JPEG" or img_pil.mode not in ("RGB", "L"):
+        return None
+    if max(img_pil.size) > MAX_PASSTHROUGH_DIMENSION:
+        return None
+    # Pillowでは無劣化の回転ができないため、回転が必要な画像は再エンコードする
+    if img_pil.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+        return None
+    return img_pil
+
+def strip_jpeg_metadata(src_path: str, dst_path: str):
+    """
+    JPEGのEXIFなどのメタデータ（STRIPPED_JPEG_MARKERS）を、画像データを再エンコードせずに取り除いてdst_pathに書き出す。
+    再エンコードする場合と同じく、撮影した端末の情報や位置情報を保存しないため。
+    JPEGとして解釈できない場合は ValueError を発生させる。
+    """
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        if src.read(2) != b"\xff\xd8":
+            raise ValueError("not a JPEG file")
+        dst.write(b"\xff\xd8")
+        while True:
+            marker = src.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                raise ValueError("invalid JPEG marker")
+            while marker[1] == 0xFF: # マーカーの前の埋め草
+                next_byte = src.read(1)
+                if not next_byte:
+                    raise ValueError("invalid JPEG marker")
+                marker = b"\xff" + next_byte
+            if marker[1] in (0xDA, 0xD9):
+                # SOS（画像データの開始）以降はそのままコピーする
+                dst.write(marker)
+                shutil.copyfileobj(src, dst)
+                return
+            length_bytes = src.read(2)
+            if len(length_bytes) < 2:
+                raise ValueError("truncated JPEG segment")
+            payload_length = int.from_bytes(length_bytes, "big") - 2
+            payload = src.read(payload_length)
+            if payload_length < 0 or len(payload) < payload_length:
+                raise ValueError("truncated JPEG segment")
+            if marker[1] not in STRIPPED_JPEG_MARKERS:
+                dst.write(marker + length_bytes + payload)
+
+def find_crop_box(image: Image.Image, scale: float, x_offset: int, y_offset: int, ip: str) -> tuple[tuple[int, int, int, int] | None, str | None]:
+    """
+    QRコードを検出し、元の画像（EXIF回転後）の座標系でのトリミング範囲 (min_x, min_y, max_x, max_y) を返す。
+    imageは元の画像を scale 倍に縮小デコードしたものでもよい。
     1. 画像を最大1800pxにリサイズしてQRコード検出のパフォーマンスを向上させる。
     2. 検出された座標を元の画像のスケールに変換する。
-    3. 元の画像を高解像度でトリミングする。
-    4. 最終的な画像を最大1080pxにリサイズして返す。
+    検出に失敗した場合は (None, 理由) を返す。
     """
-    logging.info(f"[{ip}] Starting image processing with x_offset={x_offset}, y_offset={y_offset}, mode={mode}")
-    valid, error = validate_image_file(image_data)
-    if not valid:
-        return None, error
-
-    img = read_image(image_data)
-    if img is None:
-        return None, "Failed to decode image or apply rotation."
+    img = cv2.cvtColor(np.array(to_rgb(image)), cv2.COLOR_RGB2BGR)
 
     # パフォーマンスのために画像をリサイズしてQRコードを検出
     img_for_detection, ratio = resize_image(img, 1800)
-    
+    del img
+    ratio *= scale
+
     retval, decoded_info, points, straight_qrcode = qr_detector.detectAndDecodeMulti(img_for_detection)
     logging.info(f"[{ip}] QR detection result: retval={retval}, decoded_info_size={len(decoded_info) if decoded_info is not None else 'None'}, points_len={len(points) if points is not None else 'None'}")
 
     if not retval or points is None or len(points) == 0:
         logging.warning(f"[{ip}] No QR codes found.")
-        # QRが見つからない場合は、元画像を1080pxにリサイズして返す
-        final_img, _ = resize_image(img, max_dim)
-        _, encoded_image = cv2.imencode(".jpg", final_img)
-        return encoded_image.tobytes(), "No QR codes found."
+        return None, "No QR codes found."
 
     if len(points) != 3:
         logging.warning(f"[{ip}] Expected 3 QR codes, found {len(points)}.")
-        final_img, _ = resize_image(img, max_dim)
-        _, encoded_image = cv2.imencode(".jpg", final_img)
-        return encoded_image.tobytes(), f"Exactly 3 QR codes required. Found {len(points)}"
+        return None, f"Exactly 3 QR codes required. Found {len(points)}"
 
     logging.info(f"[{ip}] Successfully detected 3 QR codes.")
 
@@ -186,10 +350,11 @@ def process_image(image_data: bytes, x_offset: int, y_offset: int, mode: str, ip
     original_points = points / ratio if ratio != 1.0 else points
 
     # 治具の左右判定
-    center_x = img.shape[1] / 2
+    w, h = round(image.size[0] / scale), round(image.size[1] / scale)
+    center_x = w / 2
     left_count = sum(1 for qr_points_set in original_points for point in qr_points_set if point[0] < center_x)
     right_count = sum(1 for qr_points_set in original_points for point in qr_points_set if point[0] >= center_x)
-    
+
     side = "right" if right_count > left_count else "left"
     logging.info(f"[{ip}] Detected side: {side}")
 
@@ -207,24 +372,149 @@ def process_image(image_data: bytes, x_offset: int, y_offset: int, mode: str, ip
     logging.info(f"[{ip}] Calculated crop coordinates: x_min={x_min}, y_min={y_min}, x_max={x_max}, y_max={y_max}")
 
     # 画像の境界内に収まるように調整
-    h, w = img.shape[:2]
     min_x, min_y = max(0, int(x_min)), max(0, int(y_min))
     max_x, max_y = min(w, int(x_max)), min(h, int(y_max))
 
     if min_x >= max_x or min_y >= max_y:
         logging.warning(f"[{ip}] Invalid QR code geometry or offsets resulted in invalid crop area.")
-        final_img, _ = resize_image(img, max_dim)
-        _, encoded_image = cv2.imencode(".jpg", final_img)
-        return encoded_image.tobytes(), "Invalid QR code geometry or offsets resulted in invalid crop area."
+        return None, "Invalid QR code geometry or offsets resulted in invalid crop area."
+
+    return (min_x, min_y, max_x, max_y), None
+
+def choose_draft_scale(side: int, min_side: int) -> int:
+    """
+    長さsideの辺を縮小デコードしたときに、min_side以上を保てる最大の縮小率（1, 2, 4, 8のいずれか）を返す。
+    """
+    for scale in (8, 4, 2):
+        if side / scale >= min_side:
+            return scale
+    return 1
+
+def load_reduced_image_pil(image_data: bytes | str, reduce: int) -> tuple[Image.Image, float]:
+    """
+    JPEGの場合はDCTスケーリング（draft）を使い、約 1/reduce の解像度で直接デコードしてEXIF回転を適用する。
+    フル解像度でデコードしてから縮小するよりも大幅に速く、メモリも少なくて済む。
+    JPEG以外、またはreduceが1の場合は通常どおりデコードする。
+    デコードした画像と、元の画像に対する倍率を返す。
+    """
+    img_pil = open_image_source(image_data)
+    full_width = img_pil.size[0]
+    if reduce > 1 and img_pil.format == "JPEG":
+        img_pil.draft("RGB", (-(-img_pil.size[0] // reduce), -(-img_pil.size[1] // reduce)))
+    scale = img_pil.size[0] / full_width
+    return ImageOps.exif_transpose(img_pil), scale
+
+def oriented_size(image_data: bytes | str) -> tuple[int, int]:
+    """
+    ピクセルをデコードせずに、EXIF回転後の画像サイズを返す。
+    """
+    with open_image_source(image_data) as img_pil:
+        width, height = img_pil.size
+        if img_pil.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8):
+            return height, width
+        return width, height
+
+def crop_by_qr(image_data: bytes | str, x_offset: int, y_offset: int, mode: str, ip: str) -> tuple["ImagePipeline", str | None]:
+    """
+    粗密2段階でQRコードの検出とトリミングを行い、最大1080pxに縮小したパイプラインを返す。
+    1. JPEGの場合は、検出に必要な1800pxを下回らない範囲で縮小デコードした画像でQRコードを検出する。
+    2. 1の画像で最終的な画像（最大1080px）に必要な解像度が足りない場合だけ、必要な解像度でデコードし直してトリミングする。
+       JPEG以外は1でフル解像度のままデコードしているため、デコードし直すことはない。
+    検出に失敗した場合は縮小のみ行い、理由を文字列として返す。
+    """
+    full_width, full_height = oriented_size(image_data)
+    detection_reduce = choose_draft_scale(max(full_width, full_height), 1800)
+    img_pil, scale = load_reduced_image_pil(image_data, detection_reduce)
+    box, error = find_crop_box(img_pil, scale, x_offset, y_offset, ip)
 
-    if mode == "outline":
-        cv2.rectangle(img, (min_x, min_y), (max_x, max_y), (0, 255, 0), 10)
-        result, _ = resize_image(img, max_dim)
+    if box is not None and mode != "outline":
+        required_side = max(box[2] - box[0], box[3] - box[1])
     else:
-        cropped_img = img[min_y:max_y, min_x:max_x]
-        squared_img = make_square(cropped_img, 0, cropped_img.shape[1], 0, cropped_img.shape[0])
-        result, _ = resize_image(squared_img, max_dim)
+        required_side = max(full_width, full_height)
+    crop_reduce = choose_draft_scale(required_side, max_dim)
+    # scale < 1 は、JPEGを縮小デコードした場合（JPEG以外は scale == 1）。
+    # 1の画像の方が解像度が高い場合（crop_reduce > detection_reduce）は、そのまま使って最後に縮小する
+    if scale < 1 and crop_reduce < detection_reduce:
+        del img_pil
+        img_pil, scale = load_reduced_image_pil(image_data, crop_reduce)
+
+    pipeline = ImagePipeline(img_pil)
+    if box is not None:
+        scaled_box = tuple(int(v * scale) for v in box)
+        if mode == "outline":
+            pipeline.outline(scaled_box)
+        else:
+            pipeline.crop_square(scaled_box)
+    pipeline.fit(max_dim)
+    return pipeline, error
 
-    _, encoded_image = cv2.imencode(".jpg", result)
+def process_image(image_data: bytes, x_offset: int, y_offset: int, mode: str, ip: str) -> tuple[bytes, str | None]:
+    """
+    QRコードを検出し、画像をトリミングして返す。
+    1. 画像を最大1800pxにリサイズしてQRコード検出のパフォーマンスを向上させる。
+    2. 検出された座標を元の画像のスケールに変換する。
+    3. 元の画像を高解像度でトリミングする。
+    4. 最終的な画像を最大1080pxにリサイズして返す。
+    """
+    logging.info(f"[{ip}] Starting image processing with x_offset={x_offset}, y_offset={y_offset}, mode={mode}")
+    valid, error = validate_image_file(image_data)
+    if not valid:
+        return None, error
+
+    try:
+        pipeline, error = crop_by_qr(image_data, x_offset, y_offset, mode, ip)
+    except Exception as e:
+        logging.error(f"Error reading or rotating image: {e}")
+        return None, "Failed to decode image or apply rotation."
+
+    encoded_image, _ = pipeline.render(quality=95)
     logging.info(f"[{ip}] Image processing completed successfully.")
-    return encoded_image.tobytes(), None
\ No newline at end of file
+    return encoded_image, error
+
+def build_upload_renditions(image_path: str | None, output_path: str, source_page: str | None, photographer_id: str, test_mode: bool = False) -> tuple[str, bytes, bool]:
+    """
+    temp_uploadの画像処理（デコード・トリミング・サムネイル生成・JPEGエンコード）をまとめて行う。
+    画像のデコードは一度だけ行い、フルサイズ画像とサムネイルは同じピクセルバッファから生成する。
+    プロセスプールのワーカーで実行されることを想定しているため、画像はファイルパスで受け渡す。
+    フルサイズ画像はoutput_pathにJPEGで書き出す。ただし再エンコードが不要なJPEGの場合は、
+    image_pathからEXIFなどのメタデータだけを取り除いてoutput_pathに書き出す（画像データはそのまま）。
+    フルサイズ画像のパス、サムネイルのJPEG、サムネイルが縮小されたかどうかを返す。
+    """
+    if test_mode:
+        pipeline = ImagePipeline.from_bytes(replace_white_with_color("static/dummy_image.png", photographer_id))
+    else:
+        # クライアント側でトリミング済みのJPEGは、再エンコードせずにメタデータだけを取り除いて保存し、サムネイルのみ生成する
+        if source_page != "upload_old" and (img_pil := open_passthrough_jpeg(image_path)) is not None:
+            try:
+                strip_jpeg_metadata(image_path, output_path)
+            except ValueError as e:
+                logging.warning(f"Cannot strip JPEG metadata, re-encoding instead: {e}")
+            else:
+                was_scaled_down = max(img_pil.size) > 600
+                img_pil.draft(img_pil.mode, (600, 600)) # DCTスケーリングで縮小デコードする
+                thumbnail_bytes, _ = ImagePipeline(img_pil).render(max_size=600, quality=85)
+                return output_path, thumbnail_bytes, was_scaled_down
+
+        # 旧ページからのアップロードはサーバー側でQRコードを検出してトリミングする
+        # サイズ超過の場合はトリミングせずにそのまま保存する
+        if source_page == "upload_old" and image_source_size(image_path) <= MAX_IMAGE_SIZE:
+            pipeline, _ = crop_by_qr(image_path, 0, 0, "auto", "127.0.0.1")
+        else:
+            pipeline = ImagePipeline.from_bytes(image_path)
+
+    pipeline.save(output_path, quality=90) # フルサイズ画像 (JPEG形式、品質90)
+    thumbnail_bytes, was_scaled_down = pipeline.render(max_size=600, quality=85) # サムネイル (JPEG形式、品質85)
+    return output_path, thumbnail_bytes, was_scaled_down
+
+def build_derivative(image_path: str, width: int, image_format: str = "JPEG", quality: int = 85) -> bytes:
+    """
+    管理画面などで表示する幅に縮小した画像（派生画像）を生成し、そのバイナリを返す。
+    JPEGの場合はDCTスケーリングで、幅がwidth以上を保てる範囲で縮小デコードしてから縮小する。
+    プロセスプールのワーカーで実行されることを想定しているため、元の画像はファイルパスで受け渡す。
+    """
+    source_width, _ = oriented_size(image_path)
+    img_pil, _ = load_reduced_image_pil(image_path, choose_draft_scale(source_width, width))
+    pipeline = ImagePipeline(img_pil)
+    pipeline.fit_width(width)
+    derivative_bytes, _ = pipeline.render(quality=quality, image_format=image_format)
+    return derivative_bytes
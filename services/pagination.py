@@ -0,0 +1,79 @@
+# pagination.py
+# (created_at, _id) によるキーセットページネーション。
+# skip() を使わず「前のページの最後のアイテムより後ろ」を検索するため、何ページ目でも1回の検索にかかる時間は一定。
+# 続きの位置はクライアントには中身を意識させないトークン（page_token）として返す。
+
+import base64
+from datetime import datetime
+
+from bson import ObjectId, json_util
+
+DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 200
+
+# created_at の降順（新しい順）。同じ created_at のアイテムは _id の降順
+PAGE_SORT = [("created_at", -1), ("_id", -1)]
+
+
+class InvalidPageTokenError(Exception):
+    """page_tokenの形式が正しくない場合に発生する例外"""
+    pass
+
+
+def encode_page_token(doc: dict) -> str:
+    """
+    ページの最後のアイテムから、次のページを取得するためのトークンを作る。
+    """
+    payload = json_util.dumps({"c": doc.get("created_at"), "i": doc["_id"]})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_page_token(token: str) -> tuple:
+    """
+    トークンを (created_at, _id) に戻す。形式が正しくない場合は InvalidPageTokenError を発生させる。
+    """
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        created_at, item_id = payload["c"], payload["i"]
+    except Exception as e:
+        raise InvalidPageTokenError() from e
+    if not isinstance(item_id, ObjectId):
+        raise InvalidPageTokenError()
+    return created_at, item_id
+
+
+def after_token_filter(query: dict, token: str | None) -> dict:
+    """
+    queryに「トークンが指すアイテムより後ろ（PAGE_SORTの順で）」という条件を追加する。
+    $lt は同じBSONの型どうしでしか比較しないが、ソートでは型の順（日時 > 文字列 > null）に並ぶ。
+    created_at の移行中（services/created_at.py）は日時と文字列が混在するため、
+    ソートで後ろに並ぶ型のアイテムも条件に含める（含めないと、日時のページの後に文字列のアイテムが返らなくなる）。
+    """
+    if not token:
+        return query
+    created_at, item_id = decode_page_token(token)
+    conditions = [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lt": item_id}},
+    ]
+    if isinstance(created_at, datetime):
+        conditions += [{"created_at": {"$type": "string"}}, {"created_at": None}]
+    elif isinstance(created_at, str):
+        conditions.append({"created_at": None})
+    return {**query, "$or": conditions}
+
+
+async def fetch_page(collection, query: dict, projection: dict | None, token: str | None, limit: int) -> tuple[list[dict], str | None]:
+    """
+    queryに一致するアイテムを、トークンの位置からlimit件だけ取得する。
+    取得したアイテムと、次のページのトークン（最後のページの場合はNone）を返す。
+    projectionを指定する場合は、含めるフィールドを指定する形式にすること（created_atは自動で追加される）。
+    """
+    if projection is not None:
+        projection = {**projection, "created_at": 1}
+    cursor = collection.find(after_token_filter(query, token), projection).sort(PAGE_SORT).limit(limit + 1)
+    docs = await cursor.to_list()
+    if len(docs) > limit:
+        docs = docs[:limit]
+        return docs, encode_page_token(docs[-1])
+    return docs, None
@@ -0,0 +1,72 @@
+# process_pool.py
+# temp_uploadなどのCPU負荷の高い画像処理を、イベントループの外（別プロセス）で実行するためのプロセスプール。
+# Pillow/OpenCVの処理をasync関数内で直接実行すると、そのgunicornワーカーの他のリクエストがすべて止まってしまう。
+#
+# 環境変数で設定できる項目:
+#   IMAGE_POOL_WORKERS     : 画像処理用のプロセス数（gunicornワーカー1つあたり）
+#   IMAGE_POOL_QUEUE_SIZE  : 実行中の処理に加えて待機させられる処理の数。これを超えると503を返す
+#   IMAGE_POOL_RETRY_AFTER : 503のRetry-Afterヘッダーに設定する秒数
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from services.image_processing import init_worker
+
+IMAGE_POOL_WORKERS = int(os.environ.get("IMAGE_POOL_WORKERS", "2"))
+IMAGE_POOL_QUEUE_SIZE = int(os.environ.get("IMAGE_POOL_QUEUE_SIZE", "8"))
+IMAGE_POOL_RETRY_AFTER = int(os.environ.get("IMAGE_POOL_RETRY_AFTER", "2"))
+
+_executor: ProcessPoolExecutor | None = None
+_in_flight = 0
+
+
+class PoolSaturatedError(Exception):
+    """プロセスプールの待ち行列が満杯で、処理を受け付けられない場合に発生する例外"""
+    pass
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    プロセスプールを返す。初回呼び出し時に生成する。
+    MongoClientのスレッドを抱えたプロセスをforkしないよう、spawnでワーカーを起動する。
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=IMAGE_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+        )
+        logging.info(f"Image process pool started: workers={IMAGE_POOL_WORKERS}, queue_size={IMAGE_POOL_QUEUE_SIZE}")
+    return _executor
+
+
+def shutdown_executor():
+    """
+    プロセスプールを停止する。アプリ終了時（lifespan）に呼ばれる。
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+async def run_in_pool(func, *args, **kwargs):
+    """
+    関数をプロセスプールで実行し、その結果を返す。
+    実行中と待機中の処理の合計が上限に達している場合は PoolSaturatedError を発生させる。
+    """
+    global _in_flight
+    if _in_flight >= IMAGE_POOL_WORKERS + IMAGE_POOL_QUEUE_SIZE:
+        raise PoolSaturatedError()
+
+    _in_flight += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), partial(func, *args, **kwargs))
+    finally:
+        _in_flight -= 1
@@ -0,0 +1,139 @@
+# temp_sweeper.py
+# 撮影途中で放置された一時画像（temporary=True）を、一定時間経過後に自動で削除する処理。
+# アプリ内ではlifespan（main.py）からバックグラウンドタスクとして定期実行される。
+# 単体で1回だけ実行することもできる:
+#   python -m services.temp_sweeper
+#
+# 環境変数で設定できる項目:
+#   TEMP_SWEEPER_ENABLED         : "false" の場合、アプリ内での定期実行を行わない（既定: true）
+#   TEMP_FILE_MAX_AGE_HOURS      : この時間より前にアップロードされた一時画像を削除する（既定: 24）
+#   TEMP_SWEEP_INTERVAL_SECONDS  : 定期実行の間隔（既定: 3600）
+#   TEMP_SWEEP_BATCH_SIZE        : 1回の削除でまとめて処理するファイル数（既定: 200）
+#   TEMP_SWEEP_PAUSE_SECONDS     : バッチごとの待ち時間。アップロード処理と競合しないように間隔を空ける（既定: 0.5）
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from db import mongo
+from services.gridfs_cleanup import delete_gridfs_files
+from services.upload_ingest import resumable_upload_path, remove_spool_file
+
+TEMP_SWEEPER_ENABLED = os.environ.get("TEMP_SWEEPER_ENABLED", "true").lower() == "true"
+TEMP_FILE_MAX_AGE_HOURS = float(os.environ.get("TEMP_FILE_MAX_AGE_HOURS", "24"))
+TEMP_SWEEP_INTERVAL_SECONDS = int(os.environ.get("TEMP_SWEEP_INTERVAL_SECONDS", "3600"))
+TEMP_SWEEP_BATCH_SIZE = int(os.environ.get("TEMP_SWEEP_BATCH_SIZE", "200"))
+TEMP_SWEEP_PAUSE_SECONDS = float(os.environ.get("TEMP_SWEEP_PAUSE_SECONDS", "0.5"))
+
+LOCK_ID = "temp_sweeper"
+
+
+async def sweep_temp_files(db: AsyncDatabase, cutoff: datetime, batch_size: int = TEMP_SWEEP_BATCH_SIZE, pause: float = TEMP_SWEEP_PAUSE_SECONDS) -> dict:
+    """
+    cutoffより前にアップロードされた一時画像を、batch_size件ずつまとめて削除する。
+    削除した画像は、撮影中の画像の一覧（upload_states）からも取り除く（temp_list / finalize_upload に残らないようにする）。
+    あわせて、cutoffより前から更新されていない撮影中の画像の一覧と、未完了の再開可能アップロードも削除する。
+    削除したファイル数とバイト数を返す。
+    """
+    query = {"temporary": True, "uploadDate": {"$lt": cutoff}}
+    files, reclaimed_bytes = 0, 0
+    while True:
+        batch = await db.fs.files.find(query, {"_id": 1, "filename": 1, "group_id": 1, "photographer_id": 1}).limit(batch_size).to_list()
+        if not batch:
+            break
+        deleted, deleted_bytes = await delete_gridfs_files(db, [file["_id"] for file in batch], extra_filter=query)
+        files += deleted
+        reclaimed_bytes += deleted_bytes
+        await remove_from_upload_states(db, batch)
+        if len(batch) < batch_size or deleted == 0:
+            break
+        if pause:
+            await asyncio.sleep(pause)
+
+    # cutoff以降に更新されていない撮影中の画像の一覧（含まれる画像はすべて上で削除済み）
+    await db.upload_states.delete_many({"updated_at": {"$lt": cutoff}})
+
+    # 再開可能アップロードの受信途中のデータ
+    sessions = 0
+    async for session in db.resumable_uploads.find({"created_at": {"$lt": cutoff}}, {"_id": 1}):
+        path = resumable_upload_path(str(session["_id"]))
+        if os.path.exists(path):
+            reclaimed_bytes += os.path.getsize(path)
+        remove_spool_file(path)
+        await db.resumable_uploads.delete_one({"_id": session["_id"]})
+        sessions += 1
+
+    return {"files": files, "bytes": reclaimed_bytes, "resumable_uploads": sessions}
+
+
+async def remove_from_upload_states(db: AsyncDatabase, files: list[dict]):
+    """
+    削除した一時画像（フルサイズ画像またはサムネイル）を含む項目を、撮影者ごとの一覧からまとめて取り除く。
+    updated_at は更新しない（撮影が再開されたように見せないため）。
+    """
+    filenames = {}
+    for file in files:
+        if file.get("group_id") is not None and file.get("photographer_id") is not None:
+            filenames.setdefault((file["group_id"], file["photographer_id"]), []).append(file["filename"])
+    if not filenames:
+        return
+    await db.upload_states.bulk_write([
+        UpdateOne(
+            {"group_id": group_id, "photographer_id": photographer_id},
+            {"$pull": {"files": {"$or": [{"filename": {"$in": names}}, {"thumbnail_filename": {"$in": names}}]}}},
+        )
+        for (group_id, photographer_id), names in filenames.items()
+    ], ordered=False)
+
+
+async def acquire_lock(db: AsyncDatabase, lock_id: str, seconds: int) -> bool:
+    """
+    複数のgunicornワーカーで同じ処理が同時に実行されないよう、job_locksコレクションでロックを取得する。
+    ロックはsecondsの間有効で、期限が切れたものは他のワーカーが取得できる。
+    """
+    now = datetime.utcnow()
+    try:
+        await db.job_locks.find_one_and_update(
+            {"_id": lock_id, "locked_until": {"$lt": now}},
+            {"$set": {"locked_until": now + timedelta(seconds=seconds), "owner": os.getpid()}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        # 他のワーカーがロックを保持している
+        return False
+
+
+async def run_sweeper():
+    """
+    一時画像の削除を TEMP_SWEEP_INTERVAL_SECONDS ごとに繰り返す。アプリのlifespanからタスクとして起動される。
+    """
+    while True:
+        await asyncio.sleep(TEMP_SWEEP_INTERVAL_SECONDS)
+        try:
+            if not await acquire_lock(mongo.db, LOCK_ID, TEMP_SWEEP_INTERVAL_SECONDS):
+                continue
+            cutoff = datetime.utcnow() - timedelta(hours=TEMP_FILE_MAX_AGE_HOURS)
+            report = await sweep_temp_files(mongo.db, cutoff)
+            logging.info(f"Temp sweeper: deleted {report['files']} files ({report['bytes']} bytes), {report['resumable_uploads']} resumable uploads")
+        except PyMongoError as e:
+            logging.error(f"Temp sweeper failed: {e}")
+
+
+async def main():
+    await mongo.connect()
+    try:
+        cutoff = datetime.utcnow() - timedelta(hours=TEMP_FILE_MAX_AGE_HOURS)
+        report = await sweep_temp_files(mongo.db, cutoff)
+        print(f"{report['files']} 件の一時画像（{report['bytes']} バイト）と {report['resumable_uploads']} 件の未完了アップロードを削除しました。")
+    finally:
+        await mongo.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
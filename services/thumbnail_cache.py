@@ -0,0 +1,307 @@
+# thumbnail_cache.py
+# 本登録済みのサムネイル画像のキャッシュ。サムネイルは小さく、本登録後は内容が変わらないため、
+# 管理画面の検索・詳細ページやn8nから繰り返し読まれるたびにGridFSから読み直さないようにする。
+#
+# 1段目: プロセス内のLRUキャッシュ（合計バイト数で上限を設ける）
+# 2段目: LRUから追い出されたサムネイルをディスク（cache/thumbnails）に保存し、FileResponse（sendfile）で返す
+#        ディスクへの書き込みはスレッドで行い、上限を超えた分の削除はバックグラウンドのタスクで行う（イベントループを止めない）
+# キーはGridFSの_id（文字列）。派生画像（services/image_derivatives.py）は「元画像の_id_w幅.形式」をキーにする。
+# 画像を削除したときは invalidate() で両方から削除する（その画像の派生画像も削除される）。
+# ※ プロセス内のキャッシュはgunicornのワーカーごとに持つ。ディスクのキャッシュは全ワーカーで共有する。
+#    invalidate() は実行したワーカーのメモリとディスクからしか削除できないため、キャッシュから返す前に
+#    呼び出し側で fs.files（派生画像の場合は元画像）が存在することを確認する（_idでの1件の検索のみ）。
+#
+# 環境変数で設定できる項目:
+#   THUMBNAIL_CACHE_MAX_BYTES      : プロセス内のキャッシュの上限（既定: 64MB）
+#   THUMBNAIL_CACHE_DIR            : ディスクのキャッシュの保存先（既定: cache/thumbnails）
+#                                    ※ temp_images は静的ファイルとして認証なしで公開されているため、その配下を指定しないこと
+#   THUMBNAIL_DISK_CACHE_MAX_BYTES : ディスクのキャッシュの上限。超えた場合は古いものから削除する（既定: 1GB）
+
+import asyncio
+import glob
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+import gridfs
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+from pymongo.asynchronous.database import AsyncDatabase
+
+from services.gridfs_response import file_etag, is_not_modified, parse_range
+
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get("THUMBNAIL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+THUMBNAIL_CACHE_DIR = os.environ.get("THUMBNAIL_CACHE_DIR", os.path.join("cache", "thumbnails"))
+THUMBNAIL_DISK_CACHE_MAX_BYTES = int(os.environ.get("THUMBNAIL_DISK_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+DISK_PRUNE_INTERVAL = 100 # ディスクへの書き込みがこの回数に達するごとに、上限を超えていないか確認する
+
+
+def file_last_modified(file_doc: dict):
+    last_modified = file_doc.get("uploadDate")
+    if last_modified is not None and last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return last_modified
+
+
+def is_cacheable(file_doc: dict) -> bool:
+    """
+    キャッシュしてよいファイルかどうか。本登録済みのサムネイルと派生画像だけを対象にする（一時画像は削除されることがあるため）。
+    """
+    return bool(file_doc.get("is_thumbnail") or file_doc.get("derivative_of")) and not file_doc.get("temporary")
+
+
+def bytes_response(request: Request, data: bytes, etag: str, last_modified, media_type: str, cache_control: str) -> Response:
+    """
+    メモリ上の画像のレスポンスを作る。GridFSから返す場合（gridfs_file_response）と同じく、
+    条件付きリクエスト、Range、HEADに対応する。
+    """
+    length = len(data)
+    headers = {"Cache-Control": cache_control, "ETag": etag, "Accept-Ranges": "bytes"}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    # If-Range が現在のETagと一致しない場合は、Rangeを無視して全体を返す
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range.strip() != etag:
+        range_header = None
+
+    try:
+        byte_range = parse_range(range_header, length)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{length}"})
+
+    status_code = 200
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+        data = data[start:end + 1]
+
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers={**headers, "Content-Length": str(len(data))}, media_type=media_type)
+    return Response(content=data, status_code=status_code, headers=headers, media_type=media_type)
+
+
+class ThumbnailCache:
+    """
+    サムネイル画像のLRUキャッシュ（プロセス内）と、ディスクのキャッシュをまとめたもの。
+    """
+
+    def __init__(self, max_bytes: int = THUMBNAIL_CACHE_MAX_BYTES, directory: str = THUMBNAIL_CACHE_DIR, disk_max_bytes: int = THUMBNAIL_DISK_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[bytes, str, object, str]] = OrderedDict() # key -> (画像, ETag, 更新日時, Content-Type)
+        self._bytes = 0
+        self._disk_writes = 0
+        self._prune_task: asyncio.Task | None = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def disk_path(self, key: str) -> str:
+        # 拡張子のないキー（サムネイル）はJPEGとして保存する
+        return os.path.join(self.directory, key if "." in key else f"{key}.jpeg")
+
+    def get(self, key: str):
+        """
+        プロセス内のキャッシュから (画像, ETag, 更新日時, Content-Type) を返す。なければNone。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def get_disk_path(self, key: str) -> str | None:
+        """
+        ディスクのキャッシュにあればそのパスを返す。なければNone。
+        """
+        path = self.disk_path(key)
+        if not os.path.exists(path):
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        return path
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    async def put(self, key: str, data: bytes, file_doc: dict, media_type: str = "image/jpeg"):
+        """
+        サムネイルをキャッシュに追加する。上限を超えた分は古いものから追い出し、ディスクに保存する（スレッドで実行する）。
+        """
+        if len(data) > self.max_bytes:
+            return
+        last_modified = file_last_modified(file_doc)
+
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key)[0])
+            # ETagはディスクから返す場合と同じく、キーとサイズから作る
+            self._entries[key] = (data, file_etag({"_id": key, "length": len(data)}), last_modified, media_type)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                old_key, old_entry = self._entries.popitem(last=False)
+                self._bytes -= len(old_entry[0])
+                self.evictions += 1
+                evicted.append((old_key, old_entry))
+
+        for old_key, (old_data, _, old_last_modified, _) in evicted:
+            if await asyncio.to_thread(self.write_disk, old_key, old_data, old_last_modified):
+                self.start_prune()
+
+    def write_disk(self, key: str, data: bytes, last_modified) -> bool:
+        """
+        ディスクのキャッシュに保存する。更新日時はLast-Modifiedとして使われるため、ファイルの更新日時に設定する。
+        ファイルのI/Oを行うため、イベントループではなくスレッドから呼び出す。
+        上限を超えていないか確認する時期になった場合はTrueを返す。
+        """
+        path = self.disk_path(key)
+        if os.path.exists(path):
+            return False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # 他のワーカーが書き込み途中のファイルを返さないよう、一時ファイルに書いてから置き換える
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            if last_modified is not None:
+                timestamp = last_modified.timestamp()
+                os.utime(tmp_path, (timestamp, timestamp))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Failed to write thumbnail cache {path}: {e}")
+            return False
+
+        with self._lock:
+            self._disk_writes += 1
+            return self._disk_writes % DISK_PRUNE_INTERVAL == 0
+
+    def start_prune(self):
+        """
+        ディスクのキャッシュの削除（prune_disk）を、バックグラウンドのタスクとしてスレッドで開始する。実行中の場合は何もしない。
+        """
+        if self._prune_task is not None and not self._prune_task.done():
+            return
+        self._prune_task = asyncio.create_task(asyncio.to_thread(self.prune_disk))
+
+    def prune_disk(self):
+        """
+        ディスクのキャッシュが上限を超えている場合、アクセス日時（保存時はアップロード日時に設定される）が古いものから削除する。
+        ファイルのI/Oを行うため、イベントループではなくスレッドから呼び出す。
+        """
+        stats = []
+        try:
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                stats.append((stat.st_atime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            return
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def invalidate(self, keys):
+        """
+        指定されたキー（GridFSの_id）の画像と、その派生画像を、プロセス内とディスクの両方のキャッシュから削除する。
+        """
+        for key in keys:
+            key = str(key)
+            with self._lock:
+                for cached_key in [k for k in self._entries if k == key or k.startswith(f"{key}_")]:
+                    self._bytes -= len(self._entries.pop(cached_key)[0])
+                    self.invalidations += 1
+            for path in [self.disk_path(key), *glob.glob(os.path.join(self.directory, f"{key}_*"))]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "disk_writes": self._disk_writes,
+            }
+
+    def response(self, request: Request, key: str, cache_control: str) -> Response | None:
+        """
+        キャッシュにあるサムネイルのレスポンスを返す。どちらのキャッシュにもなければNone。
+        """
+        if (entry := self.get(key)) is not None:
+            data, etag, last_modified, media_type = entry
+            return bytes_response(request, data, etag, last_modified, media_type, cache_control)
+
+        if (path := self.get_disk_path(key)) is not None:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            etag = file_etag({"_id": key, "length": stat.st_size})
+            headers = {"Cache-Control": cache_control, "ETag": etag}
+            last_modified = None
+            if stat.st_mtime:
+                last_modified = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+            if is_not_modified(request, etag, last_modified):
+                return Response(status_code=304, headers=headers)
+            # FileResponseはRange / HEADに対応し、サーバーが対応していればsendfileで送信される
+            media_type = mimetypes.guess_type(path)[0] or "image/jpeg"
+            return FileResponse(path, headers=headers, media_type=media_type, stat_result=stat)
+        return None
+
+
+thumbnail_cache = ThumbnailCache()
+
+
+async def cached_thumbnail_response(request: Request, db: AsyncDatabase, file_doc: dict, cache_control: str, key: str | None = None, media_type: str = "image/jpeg") -> Response:
+    """
+    サムネイル（または派生画像）のレスポンスを返す。キャッシュになければGridFSから読み込んでキャッシュに追加する。
+    keyを省略した場合はファイルの_idをキーにする。
+    """
+    key = key or str(file_doc["_id"])
+    if (response := thumbnail_cache.response(request, key, cache_control)) is not None:
+        return response
+
+    thumbnail_cache.record_miss()
+    grid_out = gridfs.AsyncGridOut(db.fs, file_document=file_doc)
+    try:
+        data = await grid_out.read()
+    finally:
+        await grid_out.close()
+    await thumbnail_cache.put(key, data, file_doc, media_type)
+    return bytes_response(request, data, file_etag({"_id": key, "length": len(data)}), file_last_modified(file_doc), media_type, cache_control)
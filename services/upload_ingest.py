@@ -0,0 +1,86 @@
+# upload_ingest.py
+# アップロードされた画像を、メモリに全体を載せずにディスク上の一時ファイルへ書き出すための処理。
+# 一時ファイルのパスをプロセスプールに渡すことで、リクエストごとのメモリ使用量を一定に抑える。
+#
+# 環境変数で設定できる項目:
+#   UPLOAD_SPOOL_DIR : 一時ファイルの保存先（未指定の場合はOSの一時ディレクトリ）
+#   ※ temp_images は静的ファイルとして公開されているため、保存先に指定しないこと
+
+import os
+import tempfile
+
+from fastapi import UploadFile
+
+from services.image_processing import MAX_IMAGE_SIZE
+
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
+CHUNK_SIZE = 1024 * 1024 # 1MB
+RESUMABLE_CHUNK_SIZE = 256 * 1024 # 再開可能アップロードでクライアントに推奨する1回あたりの送信サイズ
+
+
+class UploadTooLargeError(Exception):
+    """アップロードされたファイルがサイズ上限を超えた場合に発生する例外"""
+    pass
+
+
+def new_spool_path(suffix: str = ".upload") -> str:
+    """
+    一時ファイルを作成し、そのパスを返す。削除は呼び出し側で行う。
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=UPLOAD_SPOOL_DIR)
+    os.close(fd)
+    return path
+
+
+def resumable_upload_path(upload_id: str) -> str:
+    """
+    再開可能アップロードの受信途中のデータを保存するファイルのパスを返す。
+    gunicornの複数ワーカーから同じファイルを参照できるよう、パスはupload_idから決まる。
+    """
+    return os.path.join(UPLOAD_SPOOL_DIR or tempfile.gettempdir(), f"resumable_{upload_id}.part")
+
+
+def remove_spool_file(path: str | None):
+    """
+    一時ファイルを削除する。存在しない場合は何もしない。
+    """
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+async def spool_upload_file(file: UploadFile, max_bytes: int = MAX_IMAGE_SIZE) -> str:
+    """
+    UploadFileの内容をチャンク単位で一時ファイルへ書き出し、そのパスを返す。
+    書き出し中にmax_bytesを超えた時点で UploadTooLargeError を発生させる。
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise UploadTooLargeError()
+
+    path = new_spool_path()
+    written = 0
+    try:
+        with open(path, "wb") as f:
+            while chunk := await file.read(CHUNK_SIZE):
+                written += len(chunk)
+                if written > max_bytes:
+                    raise UploadTooLargeError()
+                f.write(chunk)
+    except BaseException:
+        remove_spool_file(path)
+        raise
+    return path
+
+
+async def copy_file_to_gridfs(fs, path: str, **fields):
+    """
+    ファイルをチャンク単位でGridFS（AsyncGridFS）に書き込み、保存したファイルの_idを返す。
+    fieldsはfs.filesのドキュメントにそのまま保存される。
+    """
+    with open(path, "rb") as f:
+        async with fs.new_file(**fields) as grid_in:
+            while chunk := f.read(CHUNK_SIZE):
+                await grid_in.write(chunk)
+    return grid_in._id
@@ -0,0 +1,100 @@
+# upload_state_backfill.py
+# 撮影中の画像の一覧（upload_states）を導入する前にアップロードされた一時画像を、一覧に追加する移行処理。
+# temp_list / temp_delete / finalize_upload は upload_states だけを参照するため、一覧にない一時画像は
+# 撮影画面に表示されず、本登録もできないまま自動削除されてしまう。
+#
+# アプリの起動時にバックグラウンドで1回実行する。複数のgunicornワーカーが同時に実行しないよう、
+# job_locksコレクションのロックを取得したワーカーだけが実行する。手動で実行する場合は、以下のコマンドを使用する:
+#   python -m services.upload_state_backfill
+#
+# 一時画像（フルサイズ画像）ごとに、同じ撮影時刻のサムネイル（ファイル名の _full を _thumb にしたもの）と組にして、
+# アップロード日時の順に一覧の先頭に追加する（導入後にアップロードされた画像より前になる）。
+# すでに一覧にある画像は追加しない。アップロード中の画像を二重に追加しないよう、BACKFILL_MIN_AGE_SECONDS より新しい画像は対象外とする。
+
+import asyncio
+import logging
+import sys
+from datetime import datetime, timedelta
+
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import PyMongoError
+
+from db import mongo
+from services.temp_sweeper import acquire_lock
+
+LOCK_ID = "upload_state_backfill"
+LOCK_SECONDS = 600
+BACKFILL_MIN_AGE_SECONDS = 60 # アップロードしてから一覧に追加されるまでの時間より十分長くする
+
+
+def thumbnail_filename_for(filename: str) -> str:
+    return filename.removesuffix("_full.jpeg") + "_thumb.jpeg"
+
+
+async def backfill_upload_states(db: AsyncDatabase) -> dict:
+    """
+    一覧にない一時画像を、グループと撮影者ごとに upload_states に追加する。追加した画像の数と一覧の数を返す。
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=BACKFILL_MIN_AGE_SECONDS)
+    temp_files = await db.fs.files.find(
+        {"temporary": True, "uploadDate": {"$lt": cutoff}},
+        {"_id": 1, "filename": 1, "group_id": 1, "photographer_id": 1, "is_thumbnail": 1},
+    ).sort("uploadDate", 1).to_list()
+
+    thumbnails = {file["filename"]: file["_id"] for file in temp_files if file.get("is_thumbnail")}
+    grouped = {}
+    for file in temp_files:
+        if file.get("is_thumbnail") or file.get("group_id") is None or file.get("photographer_id") is None:
+            continue
+        thumbnail_filename = thumbnail_filename_for(file["filename"])
+        grouped.setdefault((file["group_id"], file["photographer_id"]), []).append({
+            "file_id": file["_id"],
+            "filename": file["filename"],
+            "thumbnail_file_id": thumbnails.get(thumbnail_filename),
+            "thumbnail_filename": thumbnail_filename,
+        })
+
+    report = {"files": 0, "states": 0}
+    for (group_id, photographer_id), entries in grouped.items():
+        key = {"group_id": group_id, "photographer_id": photographer_id}
+        state = await db.upload_states.find_one(key, {"files.file_id": 1})
+        listed = {entry["file_id"] for entry in (state or {}).get("files", [])}
+        missing = [entry for entry in entries if entry["file_id"] not in listed]
+        if not missing:
+            continue
+        await db.upload_states.update_one(
+            key,
+            {"$push": {"files": {"$each": missing, "$position": 0}}, "$setOnInsert": {"updated_at": datetime.utcnow()}},
+            upsert=True,
+        )
+        report["files"] += len(missing)
+        report["states"] += 1
+    return report
+
+
+async def run_upload_state_backfill():
+    """
+    アプリのlifespanからタスクとして起動される。一覧にない一時画像がなければすぐに終わる。
+    """
+    try:
+        if not await acquire_lock(mongo.db, LOCK_ID, LOCK_SECONDS):
+            return
+        report = await backfill_upload_states(mongo.db)
+        if report["files"]:
+            logging.info(f"upload_states backfill: added {report['files']} temp files to {report['states']} upload states")
+    except PyMongoError as e:
+        logging.error(f"upload_states backfill failed: {e}")
+
+
+async def main() -> int:
+    await mongo.connect()
+    try:
+        report = await backfill_upload_states(mongo.db)
+        print(f"{report['files']} 件の一時画像を、{report['states']} 件の撮影中の画像の一覧に追加しました。")
+        return 0
+    finally:
+        await mongo.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))